@@ -1,17 +1,25 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from io import BytesIO
-import os, requests, redis, uuid, time, json
+import os, re, requests, redis, uuid
 from dotenv import load_dotenv
 from datetime import datetime
-import base64
-# Docling imports
+import base64, threading
 from bs4 import BeautifulSoup
-from features.pdf_extraction.docling_pdf_extractor import pdf_docling_converter
+# Docling is imported on the first ingest (see load_pdf_converter), not here
+from features.pdf_extraction.ingest_profiles import INGEST_PROFILES
 
 # from services import s3
 from services.s3 import S3FileManager
+from services.redis_streams import ResponseListener, inflight_key, stream_stats
+from services.wire_format import decode_response, encode_request
+from features.chat.conversation_memory import ConversationMemory
+from features.chat.table_context import DocumentTables
+from features.chat.rerank import Reranker
+from services.telemetry import API_LLM_ROUNDTRIP, COALESCED_REQUESTS, inject_trace_context, setup_tracing, timed, tracer
+from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 load_dotenv()
 
@@ -22,6 +30,9 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 app = FastAPI()
 
+setup_tracing("pdf-insights-api")
+FastAPIInstrumentor.instrument_app(app, excluded_urls="metrics")
+
 # Redis client setup
 # redis_client = redis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
 
@@ -33,13 +44,59 @@ redis_client = redis.Redis(
     password=os.getenv("REDIS_PASSWORD"),
 )
 
+# Stream entries carry binary payloads, so they are read and written without response decoding
+stream_client = redis.Redis(
+    host=os.getenv("REDIS_HOST"),
+    port=os.getenv("REDIS_PORT"),
+    decode_responses=False,
+    username=os.getenv("REDIS_USERNAME"),
+    password=os.getenv("REDIS_PASSWORD"),
+)
+
 # Stream name in Redis
 REQUEST_STREAM_NAME = os.getenv("REQUEST_STREAM_NAME")
 RESPONSE_STREAM_NAME = os.getenv("RESPONSE_STREAM_NAME")
 REQUEST_CONSUMER_GROUP = os.getenv("REQUEST_CONSUMER_GROUP")
-RESPONSE_CONSUMER_GROUP = os.getenv("RESPONSE_CONSUMER_GROUP")
-REQUEST_CONSUMER_NAME = os.getenv("REQUEST_CONSUMER_NAME")
-RESPONSE_CONSUMER_NAME = os.getenv("RESPONSE_CONSUMER_NAME")
+REQUEST_STREAM_MAXLEN = int(os.getenv("REQUEST_STREAM_MAXLEN", "10000"))
+# Identical concurrent LLM calls (same model and prompt) share one request, across replicas
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() in ("1", "true", "yes")
+RESPONSE_TIMEOUT_SECONDS = 30
+# Answer numeric questions from the exported tables instead of the full markdown tables
+TABLE_CONTEXT = os.getenv("TABLE_CONTEXT", "true").lower() in ("1", "true", "yes")
+# Lifetime of the presigned image URLs handed to the frontend
+IMAGE_URL_SECONDS = int(os.getenv("IMAGE_URL_SECONDS", "3600"))
+# Image links in extracted_data.md are relative to the document's prefix (images/<hash>.png, images/thumbs/...)
+IMAGE_REF = re.compile(r"\]\((images/[^)\s]+)\)")
+# Import Docling in the background at startup; set on replicas that serve uploads
+PRELOAD_INGEST = os.getenv("PRELOAD_INGEST", "false").lower() in ("1", "true", "yes")
+
+# Delivers responses from the worker to the request thread waiting for them
+response_listener = ResponseListener(stream_client, RESPONSE_STREAM_NAME)
+
+# Chat history per session; older turns are summarized through the same LLM queue
+conversation_memory = ConversationMemory(redis_client, lambda model, messages: generate_model_response(model, messages, priority="batch"))
+
+# Parquet tables exported at ingest, loaded per document on the first question about it
+document_tables = DocumentTables(AWS_BUCKET_NAME)
+
+# Optional cross-encoder that keeps only the best chunks of long documents (enabled by RERANK_MODEL)
+reranker = Reranker()
+
+@app.on_event("startup")
+def start_response_listener():
+    response_listener.start()
+    if PRELOAD_INGEST:
+        threading.Thread(target=load_pdf_converter, name="preload-ingest", daemon=True).start()
+
+def load_pdf_converter():
+    # Docling pulls in torch, its layout/table models and pypdfium2 (seconds of import time),
+    # so chat-only replicas never load it and ingest replicas load it once
+    from features.pdf_extraction.docling_pdf_extractor import pdf_docling_converter
+    return pdf_docling_converter
+
+@app.on_event("shutdown")
+def stop_response_listener():
+    response_listener.stop()
 
 class URLInput(BaseModel):
     url: str
@@ -48,6 +105,7 @@ class PdfInput(BaseModel):
     file: str
     file_name: str
     model: str
+    profile: str = "balanced"  # ingest profile: "fast", "balanced" or "full"
 
 class S3FileListResponse(BaseModel):
     files: List[str]
@@ -62,18 +120,32 @@ class QuestionRequest(BaseModel):
     question: str
     selected_file: str
     model: str
+    session_id: Optional[str] = None  # enables server-side conversation history
+    document: Optional[str] = None  # name of the parsed document; enables table-aware context
 
 @app.get("/")
 def read_root():
     return {"message": "Document Chat API: FastAPI Backend with Redis and LiteLLM is running"}
 
+@app.get("/metrics")
+def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/queue_stats")
+def get_queue_stats():
+    # Autoscaling signals: backlog not yet delivered (lag), delivered but un-acked (pending),
+    # and what each live worker reports as queued locally / in flight
+    stats = stream_stats(redis_client, REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP)
+    stats["api_waiting"] = response_listener.in_flight()
+    return stats
+
 @app.get("/list_pdfcontent", response_model=S3FileListResponse)
 def get_available_files():
     print("Getting available files")
     base_path = f"pdf/docling/"
     print(base_path)
     s3_obj = S3FileManager(AWS_BUCKET_NAME, base_path)
-    files = list({file.split('/')[-2] for file in s3_obj.list_files() if not file.endswith('.png')})
+    files = list({file.split('/')[-2] for file in s3_obj.list_files() if file.endswith('/extracted_data.md')})
     return {"files": files}
 
 @app.post("/select_pdfcontent")
@@ -82,7 +154,13 @@ def get_selected_pdf(request: SelectPdfResponse):
     s3_obj = S3FileManager(AWS_BUCKET_NAME, base_path)
     file = f"{base_path}{request.selected_file}/extracted_data.md"
     content = s3_obj.load_s3_file_content(file)
-    return {"content": content}
+    return {"content": content, "image_urls": image_urls(f"{base_path}{request.selected_file}/", content)}
+
+def image_urls(document_path, content):
+    # The bucket stays private: previews load thumbnails, and full-resolution images on click,
+    # through short-lived presigned URLs (signed locally, no S3 round trip)
+    s3_obj = S3FileManager(AWS_BUCKET_NAME, document_path)
+    return {path: s3_obj.get_presigned_url(path, expiration=IMAGE_URL_SECONDS) for path in set(IMAGE_REF.findall(content))}
 
 @app.post("/summarize")
 def summarize_content(request: SummarizeRequest):
@@ -98,7 +176,7 @@ def summarize_content(request: SummarizeRequest):
         ]
                 
         print(request.model)
-        summary = generate_model_response(request.model, messages)
+        summary = generate_model_response(request.model, messages, priority="batch")
         
         return {
             "summary": summary,
@@ -114,17 +192,29 @@ def ask_question(request: QuestionRequest):
         if not content:
             raise HTTPException(status_code=400, detail="No content found in selected files")
         
+        # Large tables are swapped for just the rows and columns the question is about
+        if TABLE_CONTEXT and request.document:
+            content = document_tables.build_context(request.document, content, request.question)
+        if reranker.enabled():
+            content = reranker.select_context(request.question, content)
+
         # Prepare messages for LLM
         system_message = """You are a helpful assistant. Please respond based on the following document:
 {context}
 If the question isn't related to the provided documents, politely inform the user that you can only answer questions about the selected documents.""".format(context=content)
         
-        messages = [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": request.question}
-        ]
+        if request.session_id:
+            messages = conversation_memory.build_messages(request.session_id, system_message, request.question)
+        else:
+            messages = [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": request.question}
+            ]
+        
+        answer = generate_model_response(request.model, messages, priority="interactive")
         
-        answer = generate_model_response(request.model, messages) 
+        if request.session_id and not answer.startswith("Error:"):
+            conversation_memory.append_turn(request.session_id, request.question, answer, request.model)
         
         return {
             "answer": answer,
@@ -132,9 +222,16 @@ If the question isn't related to the provided documents, politely inform the use
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error answering question: {str(e)}")
 
+@app.delete("/conversation/{session_id}")
+def reset_conversation(session_id: str):
+    conversation_memory.reset(session_id)
+    return {"message": f"Conversation {session_id} cleared"}
+
 # PDF Docling 
 @app.post("/upload_pdf")
 def process_pdf_docling(uploaded_pdf: PdfInput):
+    if uploaded_pdf.profile not in INGEST_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown ingest profile '{uploaded_pdf.profile}', expected one of {', '.join(INGEST_PROFILES)}")
     pdf_content = base64.b64decode(uploaded_pdf.file)
     # Convert pdf_content to a BytesIO stream for pymupdf
     pdf_stream = BytesIO(pdf_content)
@@ -143,10 +240,12 @@ def process_pdf_docling(uploaded_pdf: PdfInput):
     base_path = f"pdf/docling/{uploaded_pdf.file_name.replace('.','').replace(' ','')}/"
     s3_obj = S3FileManager(AWS_BUCKET_NAME, base_path)
     s3_obj.upload_file(AWS_BUCKET_NAME, f"{s3_obj.base_path}/{uploaded_pdf.file_name}", pdf_content)
-    file_name, result = pdf_docling_converter(pdf_stream, base_path, s3_obj)
+    pdf_docling_converter = load_pdf_converter()
+    file_name, result = pdf_docling_converter(pdf_stream, base_path, s3_obj, profile=uploaded_pdf.profile)
     return {
         "message": f"Data Scraped and stored in S3 \n Click the link to Download: https://{s3_obj.bucket_name}.s3.amazonaws.com/{file_name}",
-        "scraped_content": result  # Include the original scraped content in the response
+        "scraped_content": result,  # Include the original scraped content in the response
+        "image_urls": image_urls(base_path, result),
     }
     
 
@@ -179,11 +278,12 @@ def get_pdf_content(request: QuestionRequest):
     content = s3_obj.load_s3_file_content(file)
     return content
 
-def generate_model_response(model, messages):
+def generate_model_response(model, messages, priority="batch"):
     request_data = {
         "id": str(uuid.uuid4()),  # Generate a unique request ID
         "model": model,  # Replace with an available model for LiteLLM
-        "prompt": messages
+        "prompt": messages,
+        "priority": priority,  # "interactive" requests are scheduled ahead of "batch" ones by the worker
     }
     
     response = redis_communication(request_data)
@@ -191,50 +291,74 @@ def generate_model_response(model, messages):
     return response
 
 def redis_communication(request_data):
+    with tracer.start_as_current_span("llm.request") as span:
+        span.set_attribute("llm.model", request_data['model'])
+        span.set_attribute("llm.priority", request_data['priority'])
+        return publish_and_wait(request_data)
+
+def publish_and_wait(request_data):
+    inflight = None
+    if COALESCE_REQUESTS:
+        inflight = inflight_key(REQUEST_STREAM_NAME, request_data['model'], request_data['prompt'])
+        leader_id, waiter = join_inflight(inflight, request_data['id'])
+        if leader_id is None:
+            # Lost the race repeatedly; publish without coalescing
+            inflight = None
+        elif leader_id != request_data['id']:
+            # An identical request is already queued or running; wait for its reply instead of sending another
+            print(f"Request {request_data['id']} attached to in-flight request {leader_id}")
+            COALESCED_REQUESTS.labels(priority=request_data['priority']).inc()
+            return wait_for_response(leader_id, waiter, request_data['priority'])
+
     # Push request to Redis queue
     print("Pushing request to Redis Stream")
     
-    # Serialize nested data (if any) before passing to Redis
-    for key, value in request_data.items():
-        if isinstance(value, (dict, list)):
-            request_data[key] = json.dumps(value)  # Convert dict/list to a JSON string
+    # Pack the request into the compact wire envelope, carrying the current trace context to the worker
+    entry = encode_request(request_data['id'], request_data['model'], request_data['prompt'], request_data['priority'], inject_trace_context(), inflight)
     
+    # Register for the reply before publishing so it cannot arrive unseen
+    waiter = response_listener.register(request_data['id'])
+
     print("Adding data to stream...")
-    redis_client.xadd(REQUEST_STREAM_NAME, request_data)
+    # Approximate trimming keeps the request stream bounded without a full scan
+    stream_client.xadd(REQUEST_STREAM_NAME, entry, maxlen=REQUEST_STREAM_MAXLEN, approximate=True)
     
     print(f"Request {request_data['id']} pushed to Redis Stream!")
 
-    # Poll Redis for the response
-    response_key = f"response:{request_data['id']}"
-    timeout = 30  # Maximum wait time in seconds
-    start_time = time.time()
+    return wait_for_response(request_data['id'], waiter, request_data['priority'])
+
+def join_inflight(inflight, request_id):
+    """Claim the single-flight key (returns request_id, None), or return the id of the identical
+    request holding it with a waiter already registered for its reply. (None, None) if neither worked."""
+    for _ in range(3):
+        # The key lives as long as the first caller waits; the worker deletes it when it publishes the reply
+        if redis_client.set(inflight, request_id, nx=True, ex=RESPONSE_TIMEOUT_SECONDS):
+            return request_id, None
+        leader_id = redis_client.get(inflight)
+        if leader_id is None:
+            continue
+        waiter = response_listener.register(leader_id)
+        # The reply and the key's deletion are one transaction on the worker, so if the key is
+        # still here the reply has not been published yet and the listener will deliver it
+        if redis_client.get(inflight) == leader_id:
+            return leader_id, waiter
+        response_listener.unregister(leader_id, waiter)
+    return None, None
 
+def wait_for_response(request_id, waiter, priority):
     print("Waiting for response...")
 
-    while time.time() - start_time < timeout:
+    with timed(API_LLM_ROUNDTRIP, priority=priority):
+        data = response_listener.wait(request_id, waiter, RESPONSE_TIMEOUT_SECONDS)
+    if data is None:
+        return "Error: Timeout reached while waiting for response"
 
-        response_data = redis_client.xreadgroup(
-            RESPONSE_CONSUMER_GROUP, RESPONSE_CONSUMER_NAME, {RESPONSE_STREAM_NAME: ">"}, count=1, block=0
-        )
-        
-        if response_data:
-            # print(response_data)
-            for stream_name, message_data in response_data:
-                print(stream_name)
-                for message_id, data in message_data:
-                    if data['id'] == request_data['id']:
-                        # print(data['response'])
-                        print(f"Response received for {data['id']}")
-                        response = json.loads(data['response'])
-                        redis_client.xack(RESPONSE_STREAM_NAME, RESPONSE_CONSUMER_GROUP, message_id)
-                        print("Response received successfully")
-                        # Extract message content safely
-                        if "choices" in response and isinstance(response["choices"], list):
-                            message_content = response["choices"][0].get("message", {}).get("content", "No content found")
-                            print(f"Generated Response: {message_content}")
-                            return message_content
-                        else:
-                            print("Error: 'choices' field missing or invalid format in response")
-                
-    
-    return "Error: Timeout reached while waiting for response"
\ No newline at end of file
+    print(f"Response received for {data['id']}")
+    response = decode_response(data)
+    if "error" in response:
+        # The worker gave up on the request and moved it to the dead-letter stream
+        return f"Error: {response['error']}"
+    print("Response received successfully")
+    message_content = response.get("content") or "No content found"
+    print(f"Generated Response: {message_content}")
+    return message_content
@@ -0,0 +1,206 @@
+import bisect
+import itertools
+import json
+import os
+import threading
+import time
+
+# Priority classes sent by the API with every request. Lower rank is served first.
+PRIORITY_RANKS = {
+    "interactive": 0,  # /ask_question
+    "batch": 1,        # /summarize
+}
+DEFAULT_PRIORITY = "batch"
+
+# Default per-model limits, overridable with MODEL_RATE_LIMITS, e.g.
+# MODEL_RATE_LIMITS='{"gpt-4o-mini": {"rpm": 500, "tpm": 200000}}'
+DEFAULT_RPM = int(os.getenv("DEFAULT_RPM", "60"))
+DEFAULT_TPM = int(os.getenv("DEFAULT_TPM", "100000"))
+# Tokens reserved for the completion on top of the prompt estimate
+COMPLETION_TOKEN_ESTIMATE = int(os.getenv("COMPLETION_TOKEN_ESTIMATE", "512"))
+# Batch requests waiting longer than this are promoted to the interactive class
+PRIORITY_AGING_SECONDS = float(os.getenv("PRIORITY_AGING_SECONDS", "20"))
+
+
+def load_rate_limits():
+    raw = os.getenv("MODEL_RATE_LIMITS")
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError as e:
+        print(f"Ignoring invalid MODEL_RATE_LIMITS: {e}")
+        return {}
+
+
+def estimate_tokens(model, messages):
+    """Estimate the tokens a completion will consume (prompt + expected output)."""
+    try:
+        import litellm
+        prompt_tokens = litellm.token_counter(model=model, messages=messages)
+    except Exception:
+        # Rough fallback of ~4 characters per token
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+    return prompt_tokens + COMPLETION_TOKEN_ESTIMATE
+
+
+class TokenBucket:
+    """Continuously refilling bucket; capacity is the per-minute limit."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, delta):
+        # Positive delta returns tokens, negative charges extra; may go below zero
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+
+class ModelLimiter:
+    """RPM and TPM buckets for a single model, plus a cooldown after provider 429s."""
+
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+
+    def wait_time(self, tokens):
+        pause = max(0.0, self.paused_until - time.monotonic())
+        return max(pause, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def acquire(self, tokens):
+        self.requests.consume(1)
+        self.tokens.consume(tokens)
+
+    def reconcile(self, estimated, actual):
+        self.tokens.adjust(estimated - actual)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class Job:
+    def __init__(self, message_id, data, model, prompt, priority, tokens, trace=None):
+        self.message_id = message_id
+        self.data = data
+        self.model = model
+        self.prompt = prompt
+        self.priority = priority if priority in PRIORITY_RANKS else DEFAULT_PRIORITY
+        self.tokens = tokens
+        self.trace = trace  # trace context propagated from the API
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.retry_at = 0.0  # monotonic time before which a retried job must not be sent
+
+    def retry_later(self, delay):
+        self.attempts += 1
+        self.retry_at = time.monotonic() + delay
+
+    def rank(self, now):
+        rank = PRIORITY_RANKS[self.priority]
+        if rank > 0 and now - self.enqueued_at >= PRIORITY_AGING_SECONDS:
+            rank = 0
+        return rank
+
+
+class RequestScheduler:
+    """Holds pending LLM requests and releases them in priority order while
+    keeping every model under its RPM/TPM limits. A request blocked on one
+    model's limit does not hold back requests for other models.
+
+    The oldest interactive or aged batch request that doesn't fit its model's
+    budget reserves that model: nothing after it goes to the same model until
+    it fits, so a large prompt isn't starved by a stream of smaller ones."""
+
+    def __init__(self, limits=None, default_rpm=DEFAULT_RPM, default_tpm=DEFAULT_TPM):
+        self.limits = limits if limits is not None else load_rate_limits()
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.limiters = {}
+        # (enqueued_at, seq, job), oldest first; retried jobs go back in at their original age
+        self._queue = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._queue)
+
+    def limiter(self, model):
+        if model not in self.limiters:
+            config = self.limits.get(model, {})
+            self.limiters[model] = ModelLimiter(
+                config.get("rpm", self.default_rpm),
+                config.get("tpm", self.default_tpm),
+            )
+        return self.limiters[model]
+
+    def submit(self, job):
+        with self._lock:
+            bisect.insort(self._queue, (job.enqueued_at, next(self._seq), job), key=lambda entry: entry[:2])
+
+    def next_ready(self):
+        """Pop the best job that can be sent now and charge its model's buckets.
+
+        Returns (job, None) when one is ready, or (None, wait) where wait is the
+        number of seconds until the earliest pending job could go (None if empty)."""
+        with self._lock:
+            if not self._queue:
+                return None, None
+            now = time.monotonic()
+            shortest_wait = None
+            reserved = set()  # models held for an older job that doesn't fit yet
+            # Rank 0 (interactive and aged batch) first, then the rest; oldest first within each
+            for rank in sorted(set(PRIORITY_RANKS.values())):
+                for index, (_, _, job) in enumerate(self._queue):
+                    if job.rank(now) != rank or job.model in reserved:
+                        continue
+                    limiter = self.limiter(job.model)
+                    if job.retry_at > now:
+                        # Backing off after a failure, doesn't hold the model for others
+                        wait = max(job.retry_at - now, limiter.wait_time(job.tokens))
+                    else:
+                        wait = limiter.wait_time(job.tokens)
+                        if wait <= 0:
+                            limiter.acquire(job.tokens)
+                            del self._queue[index]
+                            return job, None
+                        if rank == 0:
+                            reserved.add(job.model)
+                    if shortest_wait is None or wait < shortest_wait:
+                        shortest_wait = wait
+            return None, shortest_wait
+
+    def drain(self):
+        """Remove and return every queued job."""
+        with self._lock:
+            jobs = [entry[2] for entry in self._queue]
+            self._queue = []
+            return jobs
+
+    def complete(self, job, actual_tokens):
+        with self._lock:
+            self.limiter(job.model).reconcile(job.tokens, actual_tokens)
+
+    def rate_limited(self, job, retry_after):
+        with self._lock:
+            self.limiter(job.model).pause(retry_after)
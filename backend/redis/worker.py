@@ -1,10 +1,20 @@
 import redis
-import json
+import signal
 import time
+import threading
 import litellm
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import os
 
+from backend.redis.scheduler import Job, RequestScheduler, estimate_tokens
+from services.redis_streams import consumer_name, publish_worker_stats, remove_worker_stats
+from services.wire_format import decode_entry, decode_id, decode_request, encode_error, encode_response
+from services.telemetry import (
+    LLM_LATENCY, QUEUE_WAIT, TIME_TO_FIRST_TOKEN, extract_trace_context, setup_tracing, tracer,
+)
+from prometheus_client import start_http_server
+
 load_dotenv()
 
 litellm.success_callback = ["athina"]
@@ -20,13 +30,21 @@ redis_client = redis.Redis(
     password=os.getenv("REDIS_PASSWORD"),
 )
 
+# Stream entries carry binary payloads, so they are read and written without response decoding
+stream_client = redis.Redis(
+    host=os.getenv("REDIS_HOST"),
+    port=os.getenv("REDIS_PORT"),
+    decode_responses=False,
+    username=os.getenv("REDIS_USERNAME"),
+    password=os.getenv("REDIS_PASSWORD"),
+)
+
 # Stream name in Redis
 REQUEST_STREAM_NAME = os.getenv("REQUEST_STREAM_NAME")
 RESPONSE_STREAM_NAME = os.getenv("RESPONSE_STREAM_NAME")
 REQUEST_CONSUMER_GROUP = os.getenv("REQUEST_CONSUMER_GROUP")
-RESPONSE_CONSUMER_GROUP = os.getenv("RESPONSE_CONSUMER_GROUP")
-REQUEST_CONSUMER_NAME = os.getenv("REQUEST_CONSUMER_NAME")
-RESPONSE_CONSUMER_NAME = os.getenv("RESPONSE_CONSUMER_NAME")
+# Every worker process joins the group under its own name; REQUEST_CONSUMER_NAME is only the prefix
+REQUEST_CONSUMER_NAME = consumer_name(os.getenv("REQUEST_CONSUMER_NAME", "worker"))
 
 
 # Create a consumer group if it doesn't exist (only need to be run once)
@@ -36,56 +54,343 @@ except redis.exceptions.ResponseError:
     # Consumer group already exists
     pass
 
-# Create a consumer group for the response stream if it doesn't exist (only need to be run once)
-try:
-    redis_client.xgroup_create(RESPONSE_STREAM_NAME, RESPONSE_CONSUMER_GROUP, id="0", mkstream=True)
-except redis.exceptions.ResponseError:
-    pass
-
 ATHINA_API_KEY = os.environ["ATHINA_API_KEY"]
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 XAI_API_KEY = os.getenv("XAI_API_KEY")
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY")
 
+# Scheduler settings
+MAX_IN_FLIGHT = int(os.getenv("WORKER_MAX_IN_FLIGHT", "8"))  # concurrent LLM calls
+MAX_QUEUED = int(os.getenv("WORKER_MAX_QUEUED", "100"))  # requests held locally; the rest stay in Redis
+READ_BATCH_SIZE = int(os.getenv("WORKER_READ_BATCH_SIZE", "10"))
+MAX_RATE_LIMIT_RETRIES = int(os.getenv("MAX_RATE_LIMIT_RETRIES", "5"))
+REQUEST_MAX_AGE_SECONDS = float(os.getenv("REQUEST_MAX_AGE_SECONDS", "30"))  # API stops waiting after 30s
+
+# Delivery settings
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))  # attempts after the first failure before dead-lettering
+RETRY_BACKOFF_SECONDS = float(os.getenv("RETRY_BACKOFF_SECONDS", "1"))
+CLAIM_IDLE_MS = int(os.getenv("CLAIM_IDLE_MS", "20000"))  # pending entries idle this long belong to a dead consumer
+CLAIM_INTERVAL_SECONDS = float(os.getenv("CLAIM_INTERVAL_SECONDS", "5"))  # must stay well below CLAIM_IDLE_MS
+DEAD_LETTER_STREAM_NAME = os.getenv("DEAD_LETTER_STREAM_NAME", f"{REQUEST_STREAM_NAME}:dlq")
+REQUEST_STREAM_MAXLEN = int(os.getenv("REQUEST_STREAM_MAXLEN", "10000"))
+RESPONSE_RETENTION_SECONDS = int(os.getenv("RESPONSE_RETENTION_SECONDS", "300"))
+DEAD_LETTER_STREAM_MAXLEN = int(os.getenv("DEAD_LETTER_STREAM_MAXLEN", "10000"))
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600"))
+CONSUMER_EXPIRY_MS = int(os.getenv("CONSUMER_EXPIRY_MS", "600000"))  # idle consumers with nothing pending are removed
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))  # Prometheus scrape port, 0 disables
+
+scheduler = RequestScheduler()
+executor = None  # created per run of process_requests, shut down when the worker leaves the group
+slots = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+in_flight = 0
+in_flight_lock = threading.Lock()
+stopping = threading.Event()
+
+# Un-acked request entries this worker is holding (queued or in flight), by stream id
+held = {}
+held_lock = threading.Lock()
+
+
+def message_age(message_id):
+    # Stream ids are "<milliseconds>-<sequence>"
+    return time.time() - int(message_id.split("-")[0]) / 1000
+
+
+def done_key(request_id):
+    return f"request_done:{request_id}"
+
+
+def retry_after_seconds(error, attempt):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 60)
+
+
+def release(message_id):
+    with held_lock:
+        held.pop(message_id, None)
+
+
+def finish(message_id, response_data=None, request_id=None, inflight=None):
+    """Publish the response (if any) and ack the request in a single transaction."""
+    pipe = stream_client.pipeline()
+    if response_data is not None:
+        # Drop responses older than the retention window, the API has stopped waiting for them
+        min_id = f"{int((time.time() - RESPONSE_RETENTION_SECONDS) * 1000)}-0"
+        pipe.xadd(RESPONSE_STREAM_NAME, response_data, minid=min_id, approximate=True)
+        if inflight:
+            # Closes the single flight together with the reply: an API call that still sees
+            # the key is guaranteed to be listening before the reply lands
+            pipe.delete(inflight)
+    if request_id is not None:
+        pipe.set(done_key(request_id), 1, ex=IDEMPOTENCY_TTL_SECONDS)
+    pipe.xack(REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP, message_id)
+    pipe.execute()
+    release(message_id)
+
+
+def dead_letter(message_id, data, error, attempts):
+    print(f"Moving message {message_id} to {DEAD_LETTER_STREAM_NAME} after {attempts} attempts: {error}")
+    entry = dict(data)
+    entry.update({"source_id": message_id, "error": str(error), "attempts": attempts})
+    stream_client.xadd(DEAD_LETTER_STREAM_NAME, entry, maxlen=DEAD_LETTER_STREAM_MAXLEN, approximate=True)
+    request_id = data.get("id")
+    response_data = encode_error(request_id, error) if request_id else None
+    # Let the waiting API call fail fast instead of timing out
+    finish(message_id, response_data, request_id, data.get("inflight"))
+
+
+def enqueue_request(message_id, data, attempts=0):
+    print(REQUEST_STREAM_NAME, message_id)
+    if data is None:
+        # Entry was trimmed from the stream while pending
+        finish(message_id)
+        return
+    try:
+        request_id = data["id"]
+        if redis_client.exists(done_key(request_id)):
+            # Redelivery of a request that already completed
+            print(f"Request {request_id} already processed, acking duplicate")
+            finish(message_id)
+            return
+        request = decode_request(data)
+        model, prompt = request["model"], request["prompt"]
+        job = Job(message_id, data, model, prompt, request.get("priority"), estimate_tokens(model, prompt), request.get("trace"))
+    except Exception as e:
+        # Malformed requests will never succeed
+        dead_letter(message_id, data, e, attempts)
+        return
+    job.attempts = attempts
+    with held_lock:
+        held[message_id] = job
+    scheduler.submit(job)
+
+
+def run_completion(job):
+    """Stream the completion to time the first token, then rebuild the full response."""
+    start = time.perf_counter()
+    chunks = []
+    first_token = False
+    for chunk in litellm.completion(model=job.model, messages=job.prompt, stream=True):
+        if not first_token and chunk.choices and chunk.choices[0].delta.content:
+            first_token = True
+            TIME_TO_FIRST_TOKEN.labels(model=job.model).observe(time.perf_counter() - start)
+        chunks.append(chunk)
+    LLM_LATENCY.labels(model=job.model).observe(time.perf_counter() - start)
+    return litellm.stream_chunk_builder(chunks, messages=job.prompt)
+
+
+def complete_request(job):
+    with tracer.start_as_current_span("worker.complete_request", context=extract_trace_context(job.trace)) as span:
+        span.set_attribute("llm.model", job.model)
+        span.set_attribute("llm.priority", job.priority)
+        span.set_attribute("llm.attempt", job.attempts + 1)
+        handle_request(job)
+
+
+def handle_request(job):
+    try:
+        request_id = job.data["id"]
+        if job.attempts == 0:
+            # Enqueue time comes from the stream id
+            QUEUE_WAIT.labels(model=job.model, priority=job.priority).observe(message_age(job.message_id))
+        if message_age(job.message_id) > REQUEST_MAX_AGE_SECONDS:
+            # The API has already given up on this request, don't spend quota on it
+            scheduler.complete(job, 0)
+            print(f"Dropping expired request {request_id}")
+            finish(job.message_id)
+            return
+
+        try:
+            with tracer.start_as_current_span("llm.completion"):
+                response = run_completion(job)
+        except litellm.RateLimitError as e:
+            retry_after = retry_after_seconds(e, job.attempts + 1)
+            scheduler.rate_limited(job, retry_after)
+            if job.attempts >= MAX_RATE_LIMIT_RETRIES:
+                dead_letter(job.message_id, job.data, e, job.attempts + 1)
+            else:
+                print(f"Rate limited on {request_id}, retrying in {retry_after:.1f}s")
+                job.retry_later(0)
+                scheduler.submit(job)
+            return
+
+        usage = getattr(response, "usage", None)
+        scheduler.complete(job, getattr(usage, "total_tokens", None) or job.tokens)
+
+        # Only the answer and usage stats go back to the API
+        response_data = encode_response(request_id, response)
+
+        print(f"Generated response for {request_id} successfully")
+
+        # Push the response to the response stream and ack the request
+        finish(job.message_id, response_data, request_id, job.data.get("inflight"))
+        print(f"Pushed response for {request_id} to the response stream.")
+
+    except Exception as e:
+        print(f"Error processing message {job.message_id}: {e}")
+        if job.attempts >= MAX_RETRIES:
+            dead_letter(job.message_id, job.data, e, job.attempts + 1)
+        else:
+            job.retry_later(RETRY_BACKOFF_SECONDS * 2 ** job.attempts)
+            scheduler.submit(job)
+
+
+def reclaim_pending():
+    """Keep our own pending entries alive and take over entries abandoned by dead consumers."""
+    with held_lock:
+        own_ids = list(held)
+    if own_ids:
+        # Reset the idle time of entries we are still working on so no one else claims them
+        redis_client.xclaim(
+            REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP, REQUEST_CONSUMER_NAME,
+            min_idle_time=0, message_ids=own_ids, justid=True
+        )
+
+    start_id = "0-0"
+    while len(scheduler) < MAX_QUEUED:
+        result = stream_client.xautoclaim(
+            REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP, REQUEST_CONSUMER_NAME,
+            min_idle_time=CLAIM_IDLE_MS, start_id=start_id, count=READ_BATCH_SIZE
+        )
+        # Redis 7 also returns the ids of entries that no longer exist
+        next_id = decode_id(result[0])
+        claimed = [(decode_id(message_id), decode_entry(data)) for message_id, data in result[1]]
+        deleted = [decode_id(message_id) for message_id in result[2]] if len(result) > 2 else []
+        for message_id in deleted:
+            # Trimmed from the stream while pending, nothing left to process
+            redis_client.xack(REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP, message_id)
+        if claimed:
+            deliveries = {
+                entry["message_id"]: entry["times_delivered"]
+                for entry in redis_client.xpending_range(
+                    REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP,
+                    min=claimed[0][0], max=claimed[-1][0], count=len(claimed) * 2,
+                    consumername=REQUEST_CONSUMER_NAME,
+                )
+            }
+            for message_id, data in claimed:
+                # The claim itself counts as a delivery
+                attempts = deliveries.get(message_id, 1) - 1
+                print(f"Reclaimed stale message {message_id} (attempt {attempts + 1})")
+                if attempts > MAX_RETRIES:
+                    dead_letter(message_id, data or {}, "exceeded delivery attempts", attempts)
+                else:
+                    enqueue_request(message_id, data, attempts)
+        if next_id == "0-0":
+            break
+        start_id = next_id
+
+
+def prune_dead_consumers():
+    """Remove consumers left behind by replicas that exited without leaving the group."""
+    for consumer in redis_client.xinfo_consumers(REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP):
+        if consumer["name"] != REQUEST_CONSUMER_NAME and consumer["pending"] == 0 and consumer["idle"] > CONSUMER_EXPIRY_MS:
+            print(f"Removing dead consumer {consumer['name']}")
+            redis_client.xgroup_delconsumer(REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP, consumer["name"])
+            remove_worker_stats(redis_client, REQUEST_STREAM_NAME, consumer["name"])
+
+
+def run_request(job):
+    global in_flight
+    with in_flight_lock:
+        in_flight += 1
+    try:
+        complete_request(job)
+    except Exception as e:
+        # Escaped the retry handling, e.g. Redis failing while dead-lettering or acking. Stop
+        # renewing the pending entry so XAUTOCLAIM hands it out again after CLAIM_IDLE_MS
+        print(f"Unhandled error on message {job.message_id}, leaving it for reclaim: {e}")
+        release(job.message_id)
+    finally:
+        slots.release()
+        with in_flight_lock:
+            in_flight -= 1
+
+
+def dispatch_ready():
+    """Hand every request the rate limits allow to the pool; returns seconds until the next one is due."""
+    while slots.acquire(blocking=False):
+        job, wait = scheduler.next_ready()
+        if job is None:
+            slots.release()
+            return wait
+        executor.submit(run_request, job)
+    return None
+
+
+def leave_group():
+    """Finish in-flight requests, hand queued ones back to the stream and deregister this consumer."""
+    print(f"Worker {REQUEST_CONSUMER_NAME} leaving group {REQUEST_CONSUMER_GROUP}...")
+    executor.shutdown(wait=True)
+    for job in scheduler.drain():
+        # Re-add as a new entry so another worker picks it up now instead of after CLAIM_IDLE_MS
+        pipe = stream_client.pipeline()
+        pipe.xadd(REQUEST_STREAM_NAME, job.data)
+        pipe.xack(REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP, job.message_id)
+        pipe.execute()
+        release(job.message_id)
+    remove_worker_stats(redis_client, REQUEST_STREAM_NAME, REQUEST_CONSUMER_NAME)
+    pending = redis_client.xpending_range(
+        REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP, min="-", max="+", count=1,
+        consumername=REQUEST_CONSUMER_NAME,
+    )
+    if not pending:
+        redis_client.xgroup_delconsumer(REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP, REQUEST_CONSUMER_NAME)
+    print("Worker stopped.")
+
+
+def handle_signal(signum, frame):
+    stopping.set()
+
+
 def process_requests():
-    while True:
-        
-        request_data = redis_client.xreadgroup(
-            REQUEST_CONSUMER_GROUP, REQUEST_CONSUMER_NAME, {REQUEST_STREAM_NAME: ">"}, count=1, block=0
+    global executor
+    executor = ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT)
+    setup_tracing("pdf-insights-worker")
+    if WORKER_METRICS_PORT:
+        start_http_server(WORKER_METRICS_PORT)
+    if threading.current_thread() is threading.main_thread():
+        # Embedded runs (e.g. the benchmark suite) stop the loop through `stopping` instead
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+    # Register right away so the consumer shows up in XINFO CONSUMERS before the first message
+    redis_client.xgroup_createconsumer(REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP, REQUEST_CONSUMER_NAME)
+
+    last_claim = 0.0
+    while not stopping.is_set():
+        if time.monotonic() - last_claim >= CLAIM_INTERVAL_SECONDS:
+            try:
+                reclaim_pending()
+                prune_dead_consumers()
+                publish_worker_stats(redis_client, REQUEST_STREAM_NAME, REQUEST_CONSUMER_NAME, in_flight, len(scheduler))
+            except redis.exceptions.RedisError as e:
+                print(f"Error reclaiming pending messages: {e}")
+            last_claim = time.monotonic()
+
+        wait = dispatch_ready()
+        queued = len(scheduler)
+
+        if queued >= MAX_QUEUED:
+            # Leave further requests in the stream for other workers
+            time.sleep(min(wait or 0.1, 1))
+            continue
+
+        # Only block on Redis until the next queued request is allowed to go
+        block = 1000 if not queued else max(1, int(min(wait or 0.1, 1) * 1000))
+        request_data = stream_client.xreadgroup(
+            REQUEST_CONSUMER_GROUP, REQUEST_CONSUMER_NAME, {REQUEST_STREAM_NAME: ">"},
+            count=min(READ_BATCH_SIZE, MAX_QUEUED - queued), block=block
         )
-        for stream_name, message_data in request_data:
+        for stream_name, message_data in request_data or []:
             for message_id, data in message_data:
-                
-                try:
-                    print(stream_name, message_id)
-                    redis_client.xack(REQUEST_STREAM_NAME, REQUEST_CONSUMER_GROUP, message_id)
-                    request = data
-                    request_id = request["id"]
-                    model = request["model"]
-                    prompt = json.loads(request["prompt"])
-
-                    response = litellm.completion(
-                        model=model,
-                        messages=prompt
-                    )
-                    
-                    # Prepare the response data to be added to the response stream
-                    response_data = {
-                        "id": request_id,
-                        "response": json.dumps(response.model_dump(), indent=2),  # Serialize the response to JSON
-                    }
-                    
-                    print(f"Generated response for {request_id} successfully")
-                    
-                    # Push the response to the response stream
-                    redis_client.xadd(RESPONSE_STREAM_NAME, response_data)
-                    print(f"Pushed response for {request_id} to the response stream.")
-                    
-                except Exception as e:
-                    print(f"Error processing message {message_id}: {e}")
-        time.sleep(1)
+                enqueue_request(decode_id(message_id), decode_entry(data))
+
+    leave_group()
 
 if __name__ == "__main__":
-    print("Worker started, waiting for tasks...")
-    process_requests()
\ No newline at end of file
+    print(f"Worker {REQUEST_CONSUMER_NAME} started, waiting for tasks...")
+    process_requests()
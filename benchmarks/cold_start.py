@@ -0,0 +1,123 @@
+"""Cold-start benchmark: API import time and time to the first healthy response.
+
+Each measurement runs in a fresh interpreter, the way a new replica starts:
+
+  import   seconds to `import backend.app.main`, plus the packages that
+           take longest to import (from `python -X importtime`)
+  startup  seconds from launching uvicorn until `GET /` returns 200
+
+Redis only has to be reachable for the response listener, which retries in
+the background, so no services are needed. Exits non-zero when the time to
+first healthy response misses --target-seconds.
+
+    python -m benchmarks.cold_start --runs 5 --target-seconds 3
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+COLD_START_ENV = {
+    "REDIS_HOST": "localhost",
+    "REDIS_PORT": "6379",
+    "REQUEST_STREAM_NAME": "bench:requests",
+    "RESPONSE_STREAM_NAME": "bench:responses",
+    "REQUEST_CONSUMER_GROUP": "bench-workers",
+    "AWS_BUCKET_NAME": "bench-bucket",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}
+
+
+def child_env(preload):
+    env = {**os.environ, **COLD_START_ENV, "PRELOAD_INGEST": "true" if preload else "false"}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(ROOT), env.get("PYTHONPATH")]))
+    return env
+
+
+def import_seconds(env):
+    code = "import time; s = time.perf_counter(); import backend.app.main; print(time.perf_counter() - s)"
+    output = subprocess.run([sys.executable, "-c", code], env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env, top):
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import backend.app.main"],
+                            env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+    # Sum self time per top-level package, so e.g. all of litellm or docling shows up as one line
+    totals = {}
+    for line in output.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        totals[package] = totals.get(package, 0) + int(own) / 1e6
+    return sorted(((seconds, package) for package, seconds in totals.items()), reverse=True)[:top]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def first_healthy_seconds(env, timeout):
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with {server.returncode}:\n{server.stderr.read()}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.02)
+        raise RuntimeError(f"No healthy response within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target-seconds", type=float, default=3.0, help="budget for time to first healthy response (p50)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--top", type=int, default=10, help="packages with the most import time to list")
+    parser.add_argument("--preload-ingest", action="store_true", help="start with PRELOAD_INGEST=true")
+    args = parser.parse_args()
+
+    env = child_env(args.preload_ingest)
+    imports = [import_seconds(env) for _ in range(args.runs)]
+    healthy = [first_healthy_seconds(env, args.timeout) for _ in range(args.runs)]
+
+    print(f"import backend.app.main: median {statistics.median(imports):.2f}s, max {max(imports):.2f}s")
+    print(f"first healthy response:  median {statistics.median(healthy):.2f}s, max {max(healthy):.2f}s")
+    print("\nimport time by package:")
+    for seconds, name in slowest_imports(env, args.top):
+        print(f"  {seconds:6.2f}s  {name}")
+
+    if statistics.median(healthy) > args.target_seconds:
+        print(f"\nFAIL: median time to first healthy response is over the {args.target_seconds:.1f}s target")
+        return 1
+    print(f"\nOK: within the {args.target_seconds:.1f}s target")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""Offline stand-ins for the services the app talks to, for the benchmark suite.
+
+install() must run before anything from backend/, features/ or services/ is
+imported: those modules create their Redis and S3 clients at import time.
+
+- Redis: every redis.Redis() becomes a fakeredis client on one shared
+  in-memory server (or a real server when BENCH_REDIS_URL is set).
+- S3: moto's in-memory AWS, with the bucket pre-created.
+- LLM: litellm.completion is replaced by a fake provider that waits
+  `latency` seconds before the first token, then streams the answer at
+  `tokens_per_second`.
+"""
+import os
+import time
+
+BUCKET = "bench-bucket"
+
+BENCH_ENV = {
+    "REDIS_HOST": "localhost",
+    "REDIS_PORT": "6379",
+    "REQUEST_STREAM_NAME": "bench:requests",
+    "RESPONSE_STREAM_NAME": "bench:responses",
+    "REQUEST_CONSUMER_GROUP": "bench-workers",
+    "REQUEST_CONSUMER_NAME": "bench",
+    "AWS_BUCKET_NAME": BUCKET,
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "ATHINA_API_KEY": "bench",
+    "OPENAI_API_KEY": "bench",
+    "DEFAULT_RPM": "1000000",
+    "DEFAULT_TPM": "1000000000",
+    "WORKER_METRICS_PORT": "0",
+    "REQUEST_MAX_AGE_SECONDS": "3600",
+    "CLAIM_INTERVAL_SECONDS": "1",
+}
+
+ANSWER = ("The document explains how requests flow from the API through Redis Streams "
+          "to a worker that calls the language model and publishes the answer back. ") * 2
+
+
+def install(latency=0.2, tokens_per_second=50.0):
+    """Patch Redis, S3 and LiteLLM; returns a callable that undoes the S3 mock."""
+    # Benchmark settings win over anything in a local .env
+    os.environ.update(BENCH_ENV)
+
+    import redis
+    redis_url = os.getenv("BENCH_REDIS_URL")
+    if redis_url:
+        real_redis = redis.Redis
+
+        def connect(*args, decode_responses=False, **kwargs):
+            return real_redis.from_url(redis_url, decode_responses=decode_responses)
+        redis.Redis = connect
+    else:
+        import fakeredis
+        server = fakeredis.FakeServer()
+
+        class SharedFakeRedis(fakeredis.FakeRedis):
+            def __init__(self, *args, decode_responses=False, **kwargs):
+                super().__init__(server=server, decode_responses=decode_responses)
+        redis.Redis = SharedFakeRedis
+
+    from moto import mock_aws
+    import boto3
+    aws = mock_aws()
+    aws.start()
+    boto3.client("s3").create_bucket(Bucket=BUCKET)
+
+    install_fake_llm(latency, tokens_per_second)
+    return aws.stop
+
+
+def install_fake_llm(latency, tokens_per_second):
+    import litellm
+
+    completion = litellm.completion
+
+    def fake_completion(model, messages, stream=False, **kwargs):
+        time.sleep(latency)
+        response = completion(model=model, messages=messages, mock_response=ANSWER, stream=stream, **kwargs)
+        if not stream:
+            return response
+
+        def paced():
+            for chunk in response:
+                yield chunk
+                # ~4 characters per token
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                time.sleep(len(content or "") / 4 / tokens_per_second)
+        return paced()
+
+    litellm.completion = fake_completion
+    litellm.success_callback = []
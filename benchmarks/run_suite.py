@@ -0,0 +1,237 @@
+"""Offline end-to-end benchmark suite.
+
+Runs the real API, worker and PDF pipeline in one process against fake
+Redis/S3/LLM backends (see benchmarks/harness.py) and writes the results as
+JSON so runs on different commits can be compared:
+
+    python -m benchmarks.run_suite --output bench.json
+    python -m benchmarks.run_suite --output new.json --compare bench.json
+
+Suites:
+  ingest  pages/sec converting the bundled sample PDFs per ingest profile
+          (needs Docling's models in the local cache)
+  ask     /ask_question latency percentiles under N concurrent clients
+  worker  worker throughput and memory high-water mark on a request burst
+"""
+import argparse
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
+
+from benchmarks import harness
+
+SAMPLE_PDFS = sorted((Path(__file__).resolve().parents[1] / "prototypes" / "input_pdfs").glob("*.pdf"))
+SUITES = ("ingest", "ask", "worker")
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "p50": pick(0.50), "p90": pick(0.90), "p95": pick(0.95), "p99": pick(0.99),
+        "mean": statistics.fmean(ordered), "max": ordered[-1],
+    }
+
+
+def start_worker():
+    from backend.redis import worker
+    worker.litellm.success_callback = []
+    worker.stopping.clear()
+    thread = threading.Thread(target=worker.process_requests, daemon=True)
+    thread.start()
+    return worker, thread
+
+
+def bench_ingest(profiles, repeat):
+    import pypdfium2 as pdfium
+    from features.pdf_extraction.docling_pdf_extractor import pdf_docling_converter
+    from services.s3 import S3FileManager
+
+    results = {}
+    for profile in profiles:
+        pages, elapsed = 0, 0.0
+        for run in range(repeat):
+            for pdf_path in SAMPLE_PDFS:
+                content = pdf_path.read_bytes()
+                pages += len(pdfium.PdfDocument(content))
+                # A fresh prefix per run: with an earlier manifest in place every page is reused and Docling never runs
+                s3_obj = S3FileManager(harness.BUCKET, f"pdf/docling/{pdf_path.stem}_{profile}_{run}/")
+                start = time.perf_counter()
+                pdf_docling_converter(BytesIO(content), s3_obj.base_path, s3_obj, profile=profile)
+                elapsed += time.perf_counter() - start
+        results[profile] = {"pages": pages, "seconds": elapsed, "pages_per_second": pages / elapsed}
+        print(f"ingest[{profile}]: {pages / elapsed:.2f} pages/s")
+    return results
+
+
+def bench_ask(clients, requests_per_client):
+    from fastapi.testclient import TestClient
+    from backend.app.main import app
+
+    document = (Path(__file__).resolve().parents[1] / "README.md").read_text()
+    worker, thread = start_worker()
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    with TestClient(app) as client:
+        def run_client(index):
+            nonlocal errors
+            session_id = str(uuid.uuid4())
+            for i in range(requests_per_client):
+                start = time.perf_counter()
+                response = client.post("/ask_question", json={
+                    # Distinct per client, otherwise identical prompts are coalesced into one LLM call
+                    "question": f"Client {index}, question {i}: how are requests processed?",
+                    "selected_file": document,
+                    "model": "gpt-4o-mini",
+                    "session_id": session_id,
+                })
+                elapsed = time.perf_counter() - start
+                with lock:
+                    if response.status_code == 200 and not response.json()["answer"].startswith("Error:"):
+                        latencies.append(elapsed)
+                    else:
+                        errors += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            list(pool.map(run_client, range(clients)))
+        wall = time.perf_counter() - start
+
+    worker.stopping.set()
+    thread.join()
+    if not latencies:
+        raise RuntimeError(f"All {errors} /ask_question calls failed")
+    result = {
+        "clients": clients,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "requests_per_second": len(latencies) / wall,
+        "latency_seconds": percentiles(latencies),
+    }
+    print(f"ask: p50 {result['latency_seconds']['p50'] * 1000:.0f}ms, p95 {result['latency_seconds']['p95'] * 1000:.0f}ms, {result['requests_per_second']:.1f} req/s")
+    return result
+
+
+def bench_worker(requests_count):
+    import redis
+    from services.wire_format import encode_request
+
+    client = redis.Redis(decode_responses=False)
+    stream, responses = harness.BENCH_ENV["REQUEST_STREAM_NAME"], harness.BENCH_ENV["RESPONSE_STREAM_NAME"]
+    latest = client.xrevrange(responses, count=1)
+    last_id = latest[0][0] if latest else "0-0"
+
+    tracemalloc.start()
+    worker, thread = start_worker()
+    prompt = [{"role": "user", "content": "Summarize the document in one sentence."}]
+    start = time.perf_counter()
+    pipe = client.pipeline()
+    for i in range(requests_count):
+        pipe.xadd(stream, encode_request(f"bench-{uuid.uuid4()}", "gpt-4o-mini", prompt, "batch"))
+    pipe.execute()
+
+    received, last_progress = 0, time.perf_counter()
+    while received < requests_count:
+        if time.perf_counter() - last_progress > 60:
+            raise RuntimeError(f"Worker stalled after {received}/{requests_count} responses")
+        for _, entries in client.xread({responses: last_id}, count=1000, block=1000) or []:
+            received += len(entries)
+            last_id = entries[-1][0]
+            last_progress = time.perf_counter()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    worker.stopping.set()
+    thread.join()
+    result = {
+        "requests": requests_count,
+        "seconds": elapsed,
+        "requests_per_second": requests_count / elapsed,
+        "python_peak_mb": peak / 2 ** 20,
+    }
+    print(f"worker: {result['requests_per_second']:.1f} req/s, peak {result['python_peak_mb']:.1f} MiB traced")
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from flatten(value, name)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+def compare(current, baseline_path):
+    baseline = dict(flatten(json.loads(Path(baseline_path).read_text())["results"]))
+    print(f"\nvs {baseline_path}:")
+    for name, value in flatten(current["results"]):
+        if baseline.get(name):
+            print(f"  {name:<45} {baseline[name]:>12.4g} -> {value:<12.4g} {value / baseline[name] - 1:+.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--suites", nargs="+", choices=SUITES, default=list(SUITES))
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="earlier results file to diff against")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake LLM time to first token (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="fake LLM streaming rate")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent /ask_question clients")
+    parser.add_argument("--requests-per-client", type=int, default=5)
+    parser.add_argument("--worker-requests", type=int, default=200)
+    parser.add_argument("--profiles", nargs="+", default=["fast", "balanced"])
+    parser.add_argument("--ingest-repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    stop_aws = harness.install(args.latency, args.tokens_per_second)
+    results = {}
+    try:
+        if "ingest" in args.suites:
+            results["ingest"] = bench_ingest(args.profiles, args.ingest_repeat)
+        if "ask" in args.suites:
+            results["ask"] = bench_ask(args.clients, args.requests_per_client)
+        if "worker" in args.suites:
+            results["worker"] = bench_worker(args.worker_requests)
+    finally:
+        stop_aws()
+
+    output = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(output, indent=2))
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(output, args.compare)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
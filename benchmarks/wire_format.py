@@ -0,0 +1,107 @@
+"""Micro-benchmark: previous JSON stream payloads vs the compact wire envelope.
+
+Measures bytes stored in Redis per request/response pair and the CPU time the
+API and worker spend (de)serializing them. The document used as prompt context
+is the repository README, standing in for a parsed PDF.
+
+    python -m benchmarks.wire_format --iterations 2000
+"""
+import argparse
+import json
+import time
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+
+from services.wire_format import decode_request, decode_response, encode_request, encode_response
+
+ANSWER = "The document describes a FastAPI backend that queues LLM requests through Redis Streams. " * 4
+
+
+def sample_prompt():
+    document = (Path(__file__).resolve().parents[1] / "README.md").read_text()
+    return [
+        {"role": "system", "content": f"You are a helpful assistant. Please respond based on the following document:\n{document}"},
+        {"role": "user", "content": "How are requests processed?"},
+    ]
+
+
+def sample_model_dump():
+    # Shape of litellm's ModelResponse.model_dump() for a chat completion
+    return {
+        "id": "chatcmpl-" + uuid.uuid4().hex,
+        "created": 1735000000,
+        "model": "gpt-4o-mini-2024-07-18",
+        "object": "chat.completion",
+        "system_fingerprint": "fp_0ba0d124f1",
+        "choices": [{
+            "finish_reason": "stop",
+            "index": 0,
+            "message": {"content": ANSWER, "role": "assistant", "tool_calls": None, "function_call": None},
+        }],
+        "usage": {
+            "completion_tokens": 80, "prompt_tokens": 2400, "total_tokens": 2480,
+            "completion_tokens_details": {"accepted_prediction_tokens": 0, "audio_tokens": 0, "reasoning_tokens": 0, "rejected_prediction_tokens": 0},
+            "prompt_tokens_details": {"audio_tokens": 0, "cached_tokens": 0},
+        },
+        "service_tier": "default",
+    }
+
+
+def sample_response():
+    dump = sample_model_dump()
+    return SimpleNamespace(
+        model=dump["model"],
+        choices=[SimpleNamespace(message=SimpleNamespace(content=ANSWER))],
+        usage=SimpleNamespace(**{key: dump["usage"][key] for key in ("prompt_tokens", "completion_tokens", "total_tokens")}),
+    )
+
+
+def entry_size(entry):
+    return sum(len(str(key).encode()) + len(value if isinstance(value, bytes) else str(value).encode()) for key, value in entry.items())
+
+
+def legacy_roundtrip(request_id, prompt, dump):
+    # API -> worker
+    request = {"id": request_id, "model": "gpt-4o-mini", "prompt": json.dumps(prompt), "priority": "interactive"}
+    json.loads(request["prompt"])
+    # worker -> API
+    response = {"id": request_id, "response": json.dumps(dump, indent=2)}
+    json.loads(response["response"])["choices"][0]["message"]["content"]
+    return entry_size(request) + entry_size(response)
+
+
+def wire_roundtrip(request_id, prompt, response_obj):
+    request = encode_request(request_id, "gpt-4o-mini", prompt, "interactive")
+    decode_request(request)["prompt"]
+    response = encode_response(request_id, response_obj)
+    decode_response(response)["content"]
+    return entry_size(request) + entry_size(response)
+
+
+def measure(roundtrip, iterations, *args):
+    size = roundtrip(*args)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        roundtrip(*args)
+    return size, (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    request_id = str(uuid.uuid4())
+    prompt = sample_prompt()
+    legacy_bytes, legacy_us = measure(legacy_roundtrip, args.iterations, request_id, prompt, sample_model_dump())
+    wire_bytes, wire_us = measure(wire_roundtrip, args.iterations, request_id, prompt, sample_response())
+
+    print(f"{'format':>8} {'bytes/req':>10} {'us/req':>8}")
+    print(f"{'json':>8} {legacy_bytes:>10} {legacy_us:>8.1f}")
+    print(f"{'wire':>8} {wire_bytes:>10} {wire_us:>8.1f}")
+    print(f"bytes: {wire_bytes / legacy_bytes:.0%} of json, cpu: {wire_us / legacy_us:.0%} of json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Load test: throughput of 1..N worker processes against a local Redis.
+
+Each worker runs the real backend.redis.worker loop with litellm.completion
+replaced by a fake that sleeps for a fixed latency, so the numbers measure the
+queueing/claiming path rather than a provider. With WORKER_MAX_IN_FLIGHT=1 a
+single worker tops out at 1/latency requests per second; N workers should reach
+close to N times that.
+
+    python -m benchmarks.worker_scaling --workers 1 2 4 8 --requests 200 --latency 0.1
+"""
+import argparse
+import multiprocessing
+import os
+import time
+import uuid
+
+import redis
+
+from services.wire_format import encode_request
+
+
+def run_worker(env, latency):
+    os.environ.update(env)
+    import litellm
+
+    completion = litellm.completion
+
+    def fake_completion(model, messages, **kwargs):
+        time.sleep(latency)
+        return completion(model=model, messages=messages, mock_response="ok", **kwargs)
+
+    litellm.completion = fake_completion
+    from backend.redis import worker
+
+    worker.litellm.success_callback = []
+    worker.process_requests()
+
+
+def run_round(redis_url, workers, requests_count, latency):
+    run_id = uuid.uuid4().hex[:8]
+    env = {
+        "REQUEST_STREAM_NAME": f"bench:{run_id}:requests",
+        "RESPONSE_STREAM_NAME": f"bench:{run_id}:responses",
+        "REQUEST_CONSUMER_GROUP": "bench-workers",
+        "REQUEST_CONSUMER_NAME": "bench",
+        "WORKER_MAX_IN_FLIGHT": "1",
+        "WORKER_MAX_QUEUED": "1",
+        "DEFAULT_RPM": "1000000",
+        "DEFAULT_TPM": "1000000000",
+        "REQUEST_MAX_AGE_SECONDS": "3600",
+        "WORKER_METRICS_PORT": "0",
+        "ATHINA_API_KEY": "bench",
+        "OPENAI_API_KEY": "bench",
+    }
+    # The worker connects with REDIS_* settings (db 0), so point those at the benchmark Redis
+    url = redis.connection.parse_url(redis_url)
+    env.update({
+        "REDIS_HOST": url.get("host", "localhost"),
+        "REDIS_PORT": str(url.get("port", 6379)),
+        "REDIS_USERNAME": url.get("username") or "",
+        "REDIS_PASSWORD": url.get("password") or "",
+    })
+    client = redis.Redis.from_url(redis_url, decode_responses=False)
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(env, latency)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    # Wait until every worker has joined the group
+    try:
+        client.xgroup_create(env["REQUEST_STREAM_NAME"], env["REQUEST_CONSUMER_GROUP"], id="0", mkstream=True)
+    except redis.exceptions.ResponseError:
+        # A worker created it first
+        pass
+    while len(client.xinfo_consumers(env["REQUEST_STREAM_NAME"], env["REQUEST_CONSUMER_GROUP"])) < workers:
+        time.sleep(0.1)
+
+    prompt = [{"role": "user", "content": "ping"}]
+    start = time.perf_counter()
+    pipe = client.pipeline()
+    for i in range(requests_count):
+        pipe.xadd(env["REQUEST_STREAM_NAME"], encode_request(f"{run_id}-{i}", "gpt-4o-mini", prompt, "batch"))
+    pipe.execute()
+
+    received, last_id = 0, "0-0"
+    while received < requests_count:
+        for _, entries in client.xread({env["RESPONSE_STREAM_NAME"]: last_id}, count=1000, block=5000) or []:
+            received += len(entries)
+            last_id = entries[-1][0]
+    elapsed = time.perf_counter() - start
+
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    client.delete(env["REQUEST_STREAM_NAME"], env["RESPONSE_STREAM_NAME"], f"{env['REQUEST_STREAM_NAME']}:workers")
+    return requests_count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis-url", default=os.getenv("BENCH_REDIS_URL", "redis://localhost:6379"))
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.1, help="fake LLM latency in seconds")
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'workers':>8} {'req/s':>10} {'speedup':>8} {'efficiency':>10}")
+    for workers in args.workers:
+        throughput = run_round(args.redis_url, workers, args.requests, args.latency)
+        baseline = baseline or throughput / workers
+        speedup = throughput / baseline
+        print(f"{workers:>8} {throughput:>10.1f} {speedup:>8.2f} {speedup / workers:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
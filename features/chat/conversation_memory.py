@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+
+# Token budget for the conversation part of the prompt (rolling summary + verbatim turns)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+# Most recent messages always kept verbatim (a question and its answer are two messages)
+RECENT_MESSAGES = int(os.getenv("RECENT_MESSAGES", "6"))
+# The last question and answer always go in, cut down to at least this many tokens if the budget is used up
+LAST_EXCHANGE_MIN_TOKENS = int(os.getenv("LAST_EXCHANGE_MIN_TOKENS", "500"))
+# Older messages are folded into the summary once this many are waiting
+SUMMARY_BATCH_MESSAGES = int(os.getenv("SUMMARY_BATCH_MESSAGES", "4"))
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "150"))
+CONVERSATION_TTL_SECONDS = int(os.getenv("CONVERSATION_TTL_SECONDS", "86400"))
+
+
+def count_tokens(text):
+    # ~4 characters per token; good enough for budgeting without loading a tokenizer
+    return len(text) // 4 + 1
+
+
+def truncate(text, tokens):
+    if count_tokens(text) <= tokens:
+        return text
+    return text[:max(0, tokens - 2) * 4] + " [...]"
+
+
+def fit_turns(turns, budget):
+    """Cut turns down to budget tokens in total, shortening the longest first."""
+    sizes = [count_tokens(turn["content"]) for turn in turns]
+    allowed = {}
+    for position, i in enumerate(sorted(range(len(turns)), key=lambda i: sizes[i])):
+        # Short turns (usually the question) keep their full text, the rest share what is left
+        allowed[i] = min(sizes[i], budget // (len(turns) - position))
+        budget -= allowed[i]
+    return [{**turn, "content": truncate(turn["content"], allowed[i])} for i, turn in enumerate(turns)]
+
+
+class ConversationMemory:
+    """Per-session chat history in Redis with a rolling summary of older turns.
+
+    Recent messages are replayed verbatim; once enough older ones pile up they
+    are folded into the summary by a background LLM call, so prompts stay
+    within HISTORY_TOKEN_BUDGET however long the chat runs. summarize(model,
+    messages) must return the summary text, or a string starting with
+    "Error:" on failure."""
+
+    def __init__(self, redis_client, summarize):
+        self.redis_client = redis_client
+        self.summarize = summarize
+
+    def _turns_key(self, session_id):
+        return f"conversation:{session_id}:turns"
+
+    def _summary_key(self, session_id):
+        return f"conversation:{session_id}:summary"
+
+    def _lock_key(self, session_id):
+        return f"conversation:{session_id}:summarizing"
+
+    def load(self, session_id):
+        pipe = self.redis_client.pipeline()
+        pipe.get(self._summary_key(session_id))
+        pipe.lrange(self._turns_key(session_id), 0, -1)
+        summary, turns = pipe.execute()
+        return summary or "", [json.loads(turn) for turn in turns]
+
+    def build_messages(self, session_id, system_message, question):
+        """System prompt (with the summary of earlier turns) + as many recent turns as fit + the question."""
+        summary, turns = self.load(session_id)
+        if summary:
+            system_message = f"{system_message}\n\nSummary of the earlier conversation:\n{summary}"
+
+        budget = max(HISTORY_TOKEN_BUDGET - count_tokens(summary), LAST_EXCHANGE_MIN_TOKENS)
+        # The last exchange is what a follow-up refers to, so it always goes in, shortened if one long
+        # answer would not fit otherwise
+        last = fit_turns(turns[-2:], budget)
+        budget -= sum(count_tokens(turn["content"]) for turn in last)
+        history = []
+        # Walk back over the turns before it while they fit. Turns that don't are only covered by the
+        # summary once they leave the RECENT_MESSAGES window and get folded
+        for turn in reversed(turns[:-2]):
+            budget -= count_tokens(turn["content"])
+            if budget < 0:
+                break
+            history.append(turn)
+        history.reverse()
+
+        return [{"role": "system", "content": system_message}, *history, *last, {"role": "user", "content": question}]
+
+    def append_turn(self, session_id, question, answer, model):
+        key = self._turns_key(session_id)
+        pipe = self.redis_client.pipeline()
+        pipe.rpush(key, json.dumps({"role": "user", "content": question}), json.dumps({"role": "assistant", "content": answer}))
+        pipe.expire(key, CONVERSATION_TTL_SECONDS)
+        pipe.expire(self._summary_key(session_id), CONVERSATION_TTL_SECONDS)
+        pipe.llen(key)
+        length = pipe.execute()[-1]
+
+        if length - RECENT_MESSAGES >= SUMMARY_BATCH_MESSAGES:
+            threading.Thread(target=self._fold, args=(session_id, model), daemon=True).start()
+
+    def reset(self, session_id):
+        self.redis_client.delete(self._turns_key(session_id), self._summary_key(session_id))
+
+    def _fold(self, session_id, model):
+        # One summarization per session at a time, across API replicas
+        if not self.redis_client.set(self._lock_key(session_id), 1, nx=True, ex=120):
+            return
+        try:
+            summary, turns = self.load(session_id)
+            folded = turns[:max(0, len(turns) - RECENT_MESSAGES)]
+            if not folded:
+                return
+            transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in folded)
+            messages = [
+                {"role": "system", "content": f"You maintain a running summary of a conversation about a document. Merge the new messages into the existing summary, keeping facts, names, numbers and open questions. Reply with the updated summary only, in at most {SUMMARY_MAX_WORDS} words."},
+                {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"},
+            ]
+            new_summary = self.summarize(model, messages)
+            if not new_summary or new_summary.startswith("Error:"):
+                print(f"Could not summarize conversation {session_id}: {new_summary}")
+                return
+            # New turns are only ever appended, so dropping the folded prefix is safe
+            pipe = self.redis_client.pipeline()
+            pipe.set(self._summary_key(session_id), new_summary, ex=CONVERSATION_TTL_SECONDS)
+            pipe.ltrim(self._turns_key(session_id), len(folded), -1)
+            pipe.execute()
+            print(f"Folded {len(folded)} messages into the summary of conversation {session_id}")
+        finally:
+            self.redis_client.delete(self._lock_key(session_id))
@@ -0,0 +1,175 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from features.chat.table_context import question_terms
+from features.pdf_extraction.ingest_profiles import PAGE_MARKER
+from services.telemetry import RERANK_LATENCY
+
+# Cross-encoder used to rerank chunks, e.g. cross-encoder/ms-marco-MiniLM-L-6-v2; unset disables the stage
+RERANK_MODEL = os.getenv("RERANK_MODEL", "")
+# Quantized ONNX export inside the model repo; used when onnxruntime is installed, else the PyTorch weights
+RERANK_ONNX_FILE = os.getenv("RERANK_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+# Scoring still running after this falls back to the lexical order
+RERANK_BUDGET_MS = int(os.getenv("RERANK_BUDGET_MS", "300"))
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "8"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "50000"))
+CHUNK_CHARS = int(os.getenv("CHUNK_CHARS", "1500"))
+# Documents shorter than this are sent whole
+RERANK_MIN_CHARS = int(os.getenv("RERANK_MIN_CHARS", str(CHUNK_CHARS * RERANK_TOP_N)))
+
+HEADING = re.compile(r"^#{1,6} ")
+PAGE_BREAK = re.compile(re.escape(PAGE_MARKER).replace(r"\{\}", r"\d+"))
+
+
+def split_chunks(content):
+    """Split markdown into chunks of about CHUNK_CHARS along paragraph breaks.
+
+    Each chunk starts with the heading it falls under, so it still makes sense on its
+    own, and chunks never span a page: re-ingesting an edited page only changes that
+    page's chunks, and the cached scores of all the others stay valid."""
+    chunks, heading = [], ""
+    for page in PAGE_BREAK.split(content):
+        current, size = [], 0
+        for paragraph in re.split(r"\n\s*\n", page):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            if not current or size + len(paragraph) > CHUNK_CHARS:
+                if current:
+                    chunks.append("\n\n".join(current))
+                current, size = [], 0
+                # Carry the section heading over, unless the next chunk opens a new section
+                if heading and not HEADING.match(paragraph):
+                    current, size = [heading], len(heading)
+            if HEADING.match(paragraph):
+                heading = paragraph.splitlines()[0]
+            current.append(paragraph)
+            size += len(paragraph)
+        if current:
+            chunks.append("\n\n".join(current))
+    return chunks
+
+
+def lexical_scores(question, chunks):
+    terms = question_terms(question)
+    lowered = np.char.lower(np.array(chunks, dtype=str))
+    scores = np.zeros(len(chunks), dtype=np.float32)
+    for term in terms:
+        # Longer terms are rarer and more telling
+        scores += (np.char.find(lowered, term) >= 0) * np.log1p(len(term))
+    return scores
+
+
+class Reranker:
+    """Optional cross-encoder stage for /ask_question.
+
+    Candidates come from a cheap lexical pass over the document's chunks; the
+    cross-encoder then scores (question, chunk) pairs in batches on the CPU.
+    Scores are cached per pair and the model loads in the background on first
+    use. Once scoring runs past RERANK_BUDGET_MS (checked between batches) or
+    while the model is still loading, the lexical order is used instead."""
+
+    def __init__(self, model_name=RERANK_MODEL):
+        self.model_name = model_name
+        self.model = None
+        self._loading = False
+        self._load_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def enabled(self):
+        return bool(self.model_name)
+
+    def _load(self):
+        from sentence_transformers import CrossEncoder
+        try:
+            model = CrossEncoder(self.model_name, device="cpu", backend="onnx", model_kwargs={"file_name": RERANK_ONNX_FILE})
+            print(f"Loaded reranker {self.model_name} ({RERANK_ONNX_FILE})")
+        except Exception as e:
+            # No onnxruntime/optimum, or the model has no ONNX export
+            print(f"ONNX reranker unavailable ({e}), using PyTorch weights")
+            model = CrossEncoder(self.model_name, device="cpu")
+        self.model = model
+
+    def _ensure_loaded(self):
+        if self.model is not None:
+            return True
+        with self._load_lock:
+            if not self._loading:
+                self._loading = True
+
+                def load():
+                    try:
+                        self._load()
+                    except Exception as e:
+                        # Don't retry the download on every request; the stage stays off until restart
+                        print(f"Could not load reranker {self.model_name}, disabling it: {e}")
+                        self.model_name = ""
+                    finally:
+                        self._loading = False
+                threading.Thread(target=load, name="load-reranker", daemon=True).start()
+        return False
+
+    def _key(self, question, chunk):
+        return hashlib.sha1(f"{self.model_name}\0{question}\0{chunk}".encode()).digest()
+
+    def score(self, question, chunks, deadline):
+        """Cross-encoder scores for chunks, or None if the deadline passes first."""
+        keys = [self._key(question, chunk) for chunk in chunks]
+        scores = np.empty(len(chunks), dtype=np.float32)
+        missing = []
+        with self._cache_lock:
+            for i, key in enumerate(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[i] = self._cache[key]
+                else:
+                    missing.append(i)
+
+        for start in range(0, len(missing), RERANK_BATCH_SIZE):
+            if time.perf_counter() > deadline:
+                return None
+            batch = missing[start:start + RERANK_BATCH_SIZE]
+            batch_scores = self.model.predict([(question, chunks[i]) for i in batch], batch_size=RERANK_BATCH_SIZE)
+            scores[batch] = batch_scores
+            with self._cache_lock:
+                for i, value in zip(batch, batch_scores):
+                    self._cache[keys[i]] = float(value)
+                while len(self._cache) > RERANK_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return scores
+
+    def select_context(self, question, content):
+        """The RERANK_TOP_N chunks of content most relevant to question, in document order."""
+        if len(content) < RERANK_MIN_CHARS:
+            return content
+        start = time.perf_counter()
+        chunks = split_chunks(content)
+        lexical = lexical_scores(question, chunks)
+        if not lexical.any():
+            # Nothing in the question to select on ("summarize this", "what about the second one?"):
+            # the candidates would just be the first chunks, so send the whole document instead
+            RERANK_LATENCY.labels(outcome="unmatched").observe(time.perf_counter() - start)
+            print(f"Rerank (unmatched): no chunk shares a term with the question, keeping all {len(chunks)} chunks")
+            return content
+        candidates = np.argsort(-lexical, kind="stable")[:RERANK_CANDIDATES]
+
+        outcome = "fallback"
+        selected = candidates[:RERANK_TOP_N]
+        if self._ensure_loaded():
+            scores = self.score(question, [chunks[i] for i in candidates], start + RERANK_BUDGET_MS / 1000)
+            if scores is not None:
+                outcome = "reranked"
+                selected = candidates[np.argsort(-scores, kind="stable")[:RERANK_TOP_N]]
+        RERANK_LATENCY.labels(outcome=outcome).observe(time.perf_counter() - start)
+
+        print(f"Rerank ({outcome}): {len(selected)} of {len(chunks)} chunks in {(time.perf_counter() - start) * 1000:.0f}ms")
+        return "\n\n[...]\n\n".join(chunks[i] for i in sorted(selected))
@@ -0,0 +1,168 @@
+import io
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from services.s3 import S3FileManager
+
+# Tables, rows and columns of them that are put into a prompt at most
+MAX_TABLES = int(os.getenv("TABLE_CONTEXT_MAX_TABLES", "3"))
+MAX_TABLE_ROWS = int(os.getenv("TABLE_CONTEXT_MAX_ROWS", "25"))
+MAX_TABLE_COLUMNS = int(os.getenv("TABLE_CONTEXT_MAX_COLUMNS", "8"))
+# Documents whose tables are kept in memory, least recently asked about are dropped first
+TABLE_CACHE_SIZE = int(os.getenv("TABLE_CACHE_SIZE", "32"))
+
+STOPWORDS = {
+    "the", "and", "for", "what", "which", "was", "were", "are", "is", "how", "many", "much", "did",
+    "does", "from", "with", "that", "this", "than", "there", "their", "of", "in", "on", "to", "a",
+    "an", "by", "per", "all", "any", "table", "show", "give", "list", "tell", "about", "between",
+}
+
+# Docling writes tables as markdown pipe tables: a run of lines starting with "|"
+TABLE_BLOCK = re.compile(r"(?:^\|.*(?:\n|$))+", re.MULTILINE)
+
+
+def question_terms(question):
+    words = re.findall(r"[a-z0-9][a-z0-9.%$-]*", question.lower())
+    terms = {word.rstrip(".") for word in words}
+    # Numbers (years, quarters, ids) are kept whatever their length
+    return {term for term in terms if (len(term) > 2 and term not in STOPWORDS) or any(c.isdigit() for c in term)}
+
+
+def term_hits(values, terms):
+    """Count, for every cell of a string array, how many of the terms it contains."""
+    values = np.char.lower(values.astype(str))
+    hits = np.zeros(values.shape, dtype=np.int32)
+    for term in terms:
+        hits += np.char.find(values, term) >= 0
+    return hits
+
+
+def select_slice(df, terms):
+    """Score a table against the question; returns (score, row positions, column positions)."""
+    cell_hits = term_hits(df.to_numpy(dtype=str), terms) if len(df) else np.zeros((0, len(df.columns)), dtype=np.int32)
+    header_hits = term_hits(np.array(df.columns, dtype=str), terms)
+    row_scores = cell_hits.sum(axis=1)
+    column_scores = cell_hits.sum(axis=0) + 2 * header_hits
+    score = int(row_scores.sum() + 2 * header_hits.sum())
+
+    rows = np.flatnonzero(row_scores)
+    if len(rows) > MAX_TABLE_ROWS:
+        # Best-matching rows, shown in their original order
+        rows = np.sort(rows[np.argsort(-row_scores[rows], kind="stable")[:MAX_TABLE_ROWS]])
+    elif not len(rows):
+        # Only the header matched: the question is about the whole column
+        rows = np.arange(min(len(df), MAX_TABLE_ROWS))
+
+    # The first column usually holds the row labels, keep it for context
+    columns = [0] + [i for i in np.flatnonzero(column_scores) if i != 0] if len(df.columns) else []
+    if len(columns) <= 1:
+        columns = list(range(len(df.columns)))
+    return score, rows, columns[:MAX_TABLE_COLUMNS]
+
+
+def header_matches(block, columns):
+    """Whether the header row of a markdown table block fits an exported table's columns.
+
+    Export renames empty headers to column_N, numbers repeated ones (name_2) and joins
+    multi-row headers with "." (the markdown only shows the first row)."""
+    cells = [cell.strip() for cell in block.splitlines()[0].strip().strip("|").split("|")]
+    if len(cells) != len(columns):
+        return False
+    return all(not cell or column == cell or column.startswith(f"{cell}.") or column.startswith(f"{cell}_")
+               for cell, column in zip(cells, map(str, columns)))
+
+
+def describe(number, meta):
+    label = f"Table {number}"
+    if meta.get("page"):
+        label += f" (page {meta['page']})"
+    if meta.get("caption"):
+        label += f" {meta['caption']}"
+    return label
+
+
+class DocumentTables:
+    """Tables exported at ingest (tables/index.json + one Parquet file per table) for the
+    parsed documents under pdf/docling/, used to keep large tables out of prompts.
+
+    build_context() replaces each markdown table in a document with only the rows and
+    columns that match the question, or a one-line stub when nothing in it matches.
+    When no table matches at all, the document is left as it is."""
+
+    def __init__(self, bucket_name, base_path="pdf/docling/"):
+        self.s3_obj = S3FileManager(bucket_name, base_path)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, document):
+        """[(metadata, DataFrame)] in document order; empty for documents ingested before tables were exported.
+
+        Cached per document under the ETag of tables/index.json, which every ingest rewrites, so
+        a re-upload handled by any replica is picked up on the next question (one HEAD request).
+        Only the TABLE_CACHE_SIZE most recently used documents stay in memory."""
+        index_key = f"{self.s3_obj.base_path}/{document}/tables/index.json"
+        try:
+            etag = self.s3_obj.get_etag(index_key)
+        except Exception as e:
+            print(f"No table index for {document}: {e}")
+            return []
+        with self._lock:
+            cached = self._cache.get(document)
+            if cached and cached[0] == etag:
+                self._cache.move_to_end(document)
+                return cached[1]
+
+        # pandas (and pyarrow under it) is imported on the first question about a document with
+        # tables, not when the API starts
+        import pandas as pd
+        index = json.loads(self.s3_obj.load_s3_file_bytes(index_key))
+        tables = [(meta, pd.read_parquet(io.BytesIO(self.s3_obj.load_s3_file_bytes(f"{self.s3_obj.base_path}/{document}/{meta['file']}")))) for meta in index]
+
+        with self._lock:
+            self._cache[document] = (etag, tables)
+            self._cache.move_to_end(document)
+            while len(self._cache) > TABLE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return tables
+
+    def build_context(self, document, content, question):
+        tables = self.load(document)
+        blocks = TABLE_BLOCK.findall(content)
+        if not tables or len(blocks) != len(tables):
+            # Without a one-to-one match between markdown and exported tables, leave the document as is
+            return content
+        if not all(header_matches(block, df.columns) for block, (_, df) in zip(blocks, tables)):
+            # The markdown and the tables come from different ingests (e.g. mid re-upload)
+            print(f"Exported tables for {document} don't match its markdown, sending it unchanged")
+            return content
+
+        terms = question_terms(question)
+        selections = [select_slice(df, terms) for _, df in tables]
+        ranked = sorted(range(len(tables)), key=lambda i: -selections[i][0])
+        chosen = {i for i in ranked[:MAX_TABLES] if selections[i][0] > 0}
+        if not chosen:
+            # Nothing in the question points at a table ("summarize this", a follow-up): stubbing
+            # every table would leave the LLM without any of the numbers
+            print(f"Table context for {document}: no table matches the question, sending it unchanged")
+            return content
+
+        replacements = iter(range(len(tables)))
+
+        def replace(match):
+            i = next(replacements)
+            meta, df = tables[i]
+            if i not in chosen:
+                return f"[{describe(i + 1, meta)}: {len(df)} rows x {len(df.columns)} columns, omitted]\n"
+            _, rows, columns = selections[i]
+            subset = df.iloc[rows, columns]
+            return (f"[{describe(i + 1, meta)}: {len(subset)} of {len(df)} rows, {len(subset.columns)} of {len(df.columns)} columns]\n"
+                    f"{subset.to_csv(index=False)}")
+
+        context = TABLE_BLOCK.sub(replace, content)
+        print(f"Table context for {document}: {len(content)} -> {len(context)} characters, {len(chosen)}/{len(tables)} tables kept")
+        return context
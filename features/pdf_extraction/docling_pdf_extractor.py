@@ -3,104 +3,368 @@ import io
 from docling.document_converter import DocumentConverter
 from pydantic import BaseModel
 from docling.datamodel.base_models import InputFormat, DocumentStream
-from docling_core.types.doc import ImageRefMode, PictureItem
+from docling_core.types.doc import ImageRefMode, PictureItem, TableItem
 from docling.document_converter import (
     DocumentConverter,
     PdfFormatOption,
 )
 from tempfile import NamedTemporaryFile
-from docling.datamodel.pipeline_options import PdfPipelineOptions
+from docling.datamodel.pipeline_options import PdfPipelineOptions, TableFormerMode
 from docling.backend.pypdfium2_backend import PyPdfiumDocumentBackend
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
+from docling.datamodel.settings import settings
 from services.s3 import S3FileManager
+from services.telemetry import DOCLING_STAGE, tracer
+from features.pdf_extraction.ingest_profiles import DEFAULT_INGEST_PROFILE, INGEST_PROFILES, PAGE_MARKER
 
-from datetime import datetime
+import hashlib
+import json
 import logging
+import os
+import time
 
+import pandas as pd
+from PIL import Image
+
+# DEBUG on the root logger also captures botocore/docling internals on every request; opt in with LOG_LEVEL=DEBUG
 logging.basicConfig(
     filename="output.log",  # File name where logs will be saved
-    level=logging.DEBUG,  # Log level (DEBUG logs everything)
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format="%(message)s",  # Only log the message
 )
 logger = logging.getLogger()
 
+# Record per-stage timings (layout, ocr, table_structure, ...) on every conversion result
+settings.debug.profile_pipeline_timings = True
+
 AWS_BUCKET_NAME = "pdfparserdataset"
 
-def pdf_docling_converter(pdf_stream: io.BytesIO, base_path, s3_obj):
+# Bump when the manifest layout or the per-page export changes, to force a full re-ingest
+MANIFEST_VERSION = 2
+
+# Byte-identical pictures are always stored once. Opt in to also merging pictures that only
+# look the same (a logo re-encoded on every page): perceptual hashes within this many of 256
+# bits, sizes within IMAGE_DEDUP_SIZE_TOLERANCE. Off by default, as charts drawn from one
+# template can come that close while showing different data
+IMAGE_DEDUP_PERCEPTUAL = os.getenv("IMAGE_DEDUP_PERCEPTUAL", "false").lower() in ("1", "true", "yes")
+IMAGE_DEDUP_DISTANCE = int(os.getenv("IMAGE_DEDUP_DISTANCE", "1"))
+IMAGE_DEDUP_HASH_SIZE = 16
+IMAGE_DEDUP_SIZE_TOLERANCE = 0.05
+# dHash only sees brightness gradients, so average colours must also be this close (0-255 per channel)
+IMAGE_DEDUP_COLOR_TOLERANCE = 12
+# Previews embed these; the full-resolution PNG is only linked
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "480"))
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "webp").lower()  # "webp" or "avif" (needs Pillow with AVIF support)
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "75"))
+
+# A page with fewer printable characters than this in its text layer is treated as scanned
+MIN_TEXT_CHARS = 32
+# ... as is a mostly-image page with little text (e.g. a scan with a header stamp)
+IMAGE_COVERAGE_THRESHOLD = 0.5
+IMAGE_PAGE_MAX_TEXT_CHARS = 200
+
+def classify_pages(pdf_path):
+    """Return one flag per page telling whether it needs OCR, judged from the pypdfium2 text layer."""
+    needs_ocr = []
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for page in pdf:
+            textpage = page.get_textpage()
+            text = textpage.get_text_range()
+            chars = sum(1 for c in text if not c.isspace())
 
-    # Prepare pipeline options
+            width, height = page.get_size()
+            image_area = 0.0
+            for obj in page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_IMAGE]):
+                # get_pos() was renamed get_bounds() in pypdfium2 5
+                left, bottom, right, top = obj.get_bounds() if hasattr(obj, "get_bounds") else obj.get_pos()
+                image_area += max(0.0, right - left) * max(0.0, top - bottom)
+            coverage = image_area / (width * height) if width and height else 0.0
+
+            needs_ocr.append(chars < MIN_TEXT_CHARS or (coverage >= IMAGE_COVERAGE_THRESHOLD and chars < IMAGE_PAGE_MAX_TEXT_CHARS))
+            textpage.close()
+            page.close()
+    finally:
+        pdf.close()
+    return needs_ocr
+
+def page_hashes(pdf_path):
+    """Fingerprint of every page: its size, text layer, the type and position of each object and the raw image data."""
+    hashes = []
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for page in pdf:
+            digest = hashlib.sha256(repr(page.get_size()).encode())
+            textpage = page.get_textpage()
+            digest.update(textpage.get_text_range().encode("utf-8", "surrogatepass"))
+            textpage.close()
+            for obj in page.get_objects():
+                left, bottom, right, top = obj.get_bounds() if hasattr(obj, "get_bounds") else obj.get_pos()
+                digest.update(f"{obj.type}:{left:.1f},{bottom:.1f},{right:.1f},{top:.1f}".encode())
+                if obj.type == pdfium_c.FPDF_PAGEOBJ_IMAGE:
+                    digest.update(bytes(obj.get_data(decode_simple=False)))
+            hashes.append(digest.hexdigest())
+            page.close()
+    finally:
+        pdf.close()
+    return hashes
+
+def build_pipeline_options(profile, needs_ocr):
     pipeline_options = PdfPipelineOptions()
-    pipeline_options.do_ocr = True
     pipeline_options.do_table_structure = True
     pipeline_options.images_scale = 2.0
-    pipeline_options.generate_page_images = True
     pipeline_options.generate_picture_images = True
 
-    # Initialize the DocumentConverter
-    doc_converter = DocumentConverter(
-        allowed_formats=[InputFormat.PDF],
-        format_options={
-            InputFormat.PDF: PdfFormatOption(
-                pipeline_options=pipeline_options,
-            ),
-        },
-    )
-    
+    if profile == "full":
+        pipeline_options.do_ocr = True
+        pipeline_options.generate_page_images = True
+    elif profile == "fast":
+        pipeline_options.do_ocr = False
+        pipeline_options.generate_page_images = False
+        pipeline_options.table_structure_options.mode = TableFormerMode.FAST
+    else:
+        # Docling's OCR options are per document, so one scanned page turns it on; it then only
+        # OCRs bitmap regions, which born-digital pages don't have
+        pipeline_options.do_ocr = any(needs_ocr)
+        pipeline_options.generate_page_images = False
+    return pipeline_options
+
+def load_manifest(s3_obj):
+    try:
+        return json.loads(s3_obj.load_s3_file_bytes(f"{s3_obj.base_path}/manifest.json"))
+    except Exception:
+        # First ingest of this document
+        return {}
+
+def pdf_docling_converter(pdf_stream: io.BytesIO, base_path, s3_obj, profile=DEFAULT_INGEST_PROFILE):
+    """Convert a PDF to markdown under base_path, reprocessing only the pages that changed.
+
+    manifest.json in the document's prefix keeps each page's content hash with its
+    markdown, images and tables from the last ingest. Unchanged pages are reused
+    wherever they now are in the document; only new or edited pages go through
+    Docling, and images are stored once per distinct picture (see store_image)."""
+    if profile not in INGEST_PROFILES:
+        raise ValueError(f"Unknown ingest profile '{profile}', expected one of {', '.join(INGEST_PROFILES)}")
+
     pdf_stream.seek(0)
     with NamedTemporaryFile(suffix=".pdf", delete=True) as temp_file:
         # Write the PDF bytes to a temporary file
         temp_file.write(pdf_stream.read())
         temp_file.flush()
         print(Path(temp_file.name))
-        # Convert the PDF file to markdown
-        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        # md_file_name = f"{s3_obj.base_path}/extracted_{timestamp}.md"
-        md_file_name = f"{s3_obj.base_path}/extracted_data.md"
-        # doc_stream = DocumentStream({"name": md_file_name, "stream": pdf_stream})
-        conv_result = doc_converter.convert(temp_file.name)
-        
-        final_md_content = document_convert(conv_result, base_path, s3_obj)
-
-        # Upload the markdown file to S3   
-        s3_obj.upload_file(s3_obj.bucket_name, md_file_name ,final_md_content.encode('utf-8'))
-        
+
+        previous = load_manifest(s3_obj)
+        hashes = page_hashes(temp_file.name)
+        # A different profile or export layout changes every page's output
+        reusable = previous.get("version") == MANIFEST_VERSION and previous.get("profile") == profile
+        # Matched by hash rather than position, so inserting or removing a page only converts that page
+        old_pages = {page["hash"]: page for page in previous.get("pages", [])} if reusable else {}
+        pages = [reuse_page(old_pages[digest], i + 1) if digest in old_pages else None for i, digest in enumerate(hashes)]
+        changed = [i for i, page in enumerate(pages) if page is None]
+        print(f"{len(changed)}/{len(hashes)} pages changed since the last ingest")
+        # Images are stored under their content hash, so whatever is already uploaded can be reused
+        stored = {}
+        if previous.get("version") == MANIFEST_VERSION:
+            for page in previous["pages"]:
+                stored.update(page["images"])
+
+        if changed:
+            conv_result = convert_pages(temp_file.name, changed, len(hashes), profile)
+            with tracer.start_as_current_span("docling.export"):
+                image_export_seconds = 0.0
+                # Converted pages are numbered 1..len(changed) in conv_result
+                for page_no, i in enumerate(changed, start=1):
+                    pages[i], seconds = export_page(conv_result.document, page_no, i + 1, s3_obj, stored)
+                    pages[i]["hash"] = hashes[i]
+                    image_export_seconds += seconds
+                DOCLING_STAGE.labels(stage="image_export").observe(image_export_seconds)
+
+    md_file_name = f"{s3_obj.base_path}/extracted_data.md"
+    final_md_content = "\n\n".join(f"{PAGE_MARKER.format(number)}\n\n{page['markdown']}" for number, page in enumerate(pages, start=1))
+    # Pages that were only inserted, removed or moved still change the markdown and the tables' page numbers
+    if changed or hashes != [page["hash"] for page in previous.get("pages", [])]:
+        s3_obj.upload_file(s3_obj.bucket_name, md_file_name, final_md_content.encode('utf-8'))
+        tables = [table for page in pages for table in page["tables"]]
+        s3_obj.upload_file(s3_obj.bucket_name, f"{s3_obj.base_path}/tables/index.json", json.dumps(tables).encode("utf-8"))
+
+        # Written after the markdown and tables: if anything above fails, the next ingest redoes these pages
+        manifest = {"version": MANIFEST_VERSION, "profile": profile, "pages": pages}
+        s3_obj.upload_file(s3_obj.bucket_name, f"{s3_obj.base_path}/manifest.json", json.dumps(manifest).encode("utf-8"))
+
+        # Images and tables of edited or removed pages that are no longer referenced. Deleted only once
+        # the new manifest is in place, since the next ingest reuses whatever the manifest lists;
+        # if this fails the objects are just left behind
+        current, stale = artifact_keys(pages, s3_obj), artifact_keys(previous.get("pages", []), s3_obj)
+        if stale - current:
+            s3_obj.delete_files(stale - current)
+
     # Return the markdown file name and content
     return md_file_name, final_md_content
 
-def document_convert(conv_result, base_path, s3_obj):
-    final_md_content = conv_result.document.export_to_markdown(image_mode=ImageRefMode.PLACEHOLDER)
-    doc_filename = conv_result.input.file.stem
+def reuse_page(entry, page_number):
+    """Manifest entry of an unchanged page, moved to page_number. Images and tables are keyed by
+    content, so only the page numbers in the table metadata change."""
+    return {**entry, "tables": [{**table, "page": page_number} for table in entry["tables"]]}
+
+def artifact_keys(pages, s3_obj):
+    keys = set()
+    for page in pages:
+        for image, info in page.get("images", {}).items():
+            # Manifests before version 2 keyed images by full S3 key and had no thumbnails
+            keys.add(image if image.startswith(s3_obj.base_path) else f"{s3_obj.base_path}/{image}")
+            if isinstance(info, dict):
+                keys.add(f"{s3_obj.base_path}/{info['thumbnail']}")
+        keys |= {f"{s3_obj.base_path}/{table['file']}" for table in page.get("tables", [])}
+    return keys
+
+def dhash(image, size=IMAGE_DEDUP_HASH_SIZE):
+    """size*size-bit difference hash: survives re-encoding, rescaling and small rendering differences."""
+    pixels = image.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS).tobytes()
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            bits = (bits << 1) | (pixels[row * (size + 1) + col] > pixels[row * (size + 1) + col + 1])
+    return bits
+
+def make_thumbnail(image):
+    thumbnail = image.copy()
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    image_format = THUMBNAIL_FORMAT
+    Image.init()
+    if image_format == "avif" and "AVIF" not in Image.SAVE:
+        print("Pillow was built without AVIF support, writing WebP thumbnails")
+        image_format = "webp"
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, image_format.upper(), quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue(), image_format
+
+def store_image(image, s3_obj, stored):
+    """Upload a picture once and return its key relative to the document prefix.
+
+    Pictures are keyed by the hash of their PNG bytes; a picture that is byte-identical
+    to one in stored (key -> info, from this document's earlier pages and ingests), or
+    with IMAGE_DEDUP_PERCEPTUAL perceptually the same, reuses that key instead of being
+    uploaded again."""
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    key = f"images/{hashlib.sha256(buffer.getvalue()).hexdigest()[:32]}.png"
+    if key in stored:
+        return key
+
+    # Hashed either way, so turning perceptual matching on later also covers pictures stored before
+    phash = f"{dhash(image):0{IMAGE_DEDUP_HASH_SIZE ** 2 // 4}x}"
+    width, height = image.size
+    color = list(image.convert("RGB").resize((1, 1), Image.Resampling.BOX).getpixel((0, 0)))
+    for other_key, info in stored.items() if IMAGE_DEDUP_PERCEPTUAL else ():
+        other_width, other_height = info["size"]
+        # Pictures stored before the hash grew to 256 bits have 64-bit hashes and are not compared
+        if (len(info["phash"]) == len(phash)
+                and bin(int(phash, 16) ^ int(info["phash"], 16)).count("1") <= IMAGE_DEDUP_DISTANCE
+                and abs(width - other_width) <= IMAGE_DEDUP_SIZE_TOLERANCE * other_width
+                and abs(height - other_height) <= IMAGE_DEDUP_SIZE_TOLERANCE * other_height
+                and all(abs(a - b) <= IMAGE_DEDUP_COLOR_TOLERANCE for a, b in zip(color, info["color"]))):
+            return other_key
+
+    thumbnail, image_format = make_thumbnail(image)
+    thumbnail_key = f"images/thumbs/{key[len('images/'):-len('.png')]}.{image_format}"
+    s3_obj.upload_file(s3_obj.bucket_name, f"{s3_obj.base_path}/{key}", buffer.getvalue())
+    s3_obj.upload_file(s3_obj.bucket_name, f"{s3_obj.base_path}/{thumbnail_key}", thumbnail)
+    stored[key] = {"phash": phash, "size": [width, height], "color": color, "thumbnail": thumbnail_key}
+    return key
 
-    picture_counter = 0
-    for element, _level in conv_result.document.iterate_items():
+def convert_pages(pdf_path, pages, page_count, profile):
+    """Run Docling on the given 0-based pages of the PDF, as a document of their own."""
+    with NamedTemporaryFile(suffix=".pdf", delete=True) as subset_file:
+        if len(pages) < page_count:
+            pdf = pdfium.PdfDocument(pdf_path)
+            subset = pdfium.PdfDocument.new()
+            subset.import_pages(pdf, pages)
+            subset.save(subset_file)
+            subset_file.flush()
+            subset.close()
+            pdf.close()
+            pdf_path = subset_file.name
+
+        # Only the balanced profile looks at the pages; fast and full decide up front
+        needs_ocr = classify_pages(pdf_path) if profile == "balanced" else []
+        pipeline_options = build_pipeline_options(profile, needs_ocr)
+        if needs_ocr:
+            print(f"{sum(needs_ocr)}/{len(needs_ocr)} pages without a text layer")
+        print(f"Ingest profile '{profile}': OCR {'on' if pipeline_options.do_ocr else 'off'}")
+
+        # Initialize the DocumentConverter
+        doc_converter = DocumentConverter(
+            allowed_formats=[InputFormat.PDF],
+            format_options={
+                InputFormat.PDF: PdfFormatOption(
+                    pipeline_options=pipeline_options,
+                ),
+            },
+        )
+        with tracer.start_as_current_span("docling.convert") as span:
+            span.set_attribute("docling.profile", profile)
+            span.set_attribute("docling.pages", len(pages))
+            conv_result = doc_converter.convert(pdf_path)
+            for stage, timing in conv_result.timings.items():
+                DOCLING_STAGE.labels(stage=stage).observe(sum(timing.times))
+    return conv_result
+
+def export_page(document, page_no, page_number, s3_obj, stored):
+    """Markdown, images and tables of one converted page, as its manifest entry.
+
+    page_no is the page in the converted document, page_number the page in the uploaded
+    PDF. Returns the entry and the seconds spent rendering and storing images."""
+    markdown = document.export_to_markdown(page_no=page_no, image_mode=ImageRefMode.PLACEHOLDER)
+    images, tables = {}, []
+    image_export_seconds = 0.0
+    for element, _level in document.iterate_items(page_no=page_no):
         if isinstance(element, PictureItem):
-            picture_counter += 1
-            
-            # Save the image to a file
-            element_image_filename = f"{s3_obj.base_path}/images/{doc_filename}_image_{picture_counter}.png"
-
-            # Upload the image file to S3   
-            # image_data = 
-
-            # with element_image_filename.open("wb") as fp:
-            #     element.get_image(conv_result.document).save(fp, "PNG")
-            
-            with NamedTemporaryFile(suffix=".png", delete=True) as image_file:
-                #image_file.write(image_data)
-                element.get_image(conv_result.document).save(image_file, "PNG")
-                image_file.flush()
-                                
-                # Upload the image file to S3   
-                with open(image_file.name, "rb") as fp:
-                    s3_obj.upload_file(s3_obj.bucket_name, element_image_filename, fp.read())
-                    
-                # s3_obj.upload_file(s3_obj.bucket_name, element_image_filename, image_file)
-                
-                element_image_link = f"https://{s3_obj.bucket_name}.s3.amazonaws.com/{f"{element_image_filename}"}"
-            
-                print(element_image_link)
-                
-            # Replace the image placeholder with the image filename
-            final_md_content = final_md_content.replace("<!-- image -->", f"![Image]({element_image_link})", 1)
-            
-
-    return final_md_content
+            export_start = time.perf_counter()
+            image = element.get_image(document)
+            if image is None:
+                # Use up its placeholder, or the next picture would be linked in this one's place
+                markdown = markdown.replace("<!-- image -->", "", 1)
+                continue
+            key = store_image(image, s3_obj, stored)
+            images[key] = stored[key]
+            image_export_seconds += time.perf_counter() - export_start
+
+            # Image paths are relative to the document's prefix; the API turns them into presigned
+            # URLs for previews. The thumbnail is embedded, clicking it opens the full-resolution PNG
+            markdown = markdown.replace("<!-- image -->", f"[![Image]({stored[key]['thumbnail']})]({key})", 1)
+
+        elif isinstance(element, TableItem):
+            df = table_dataframe(element, document)
+            buffer = io.BytesIO()
+            df.to_parquet(buffer, index=False)
+            # Keyed by content like images, so the file stays valid when its page moves
+            table_file = f"tables/{hashlib.sha256(buffer.getvalue()).hexdigest()[:32]}.parquet"
+            s3_obj.upload_file(s3_obj.bucket_name, f"{s3_obj.base_path}/{table_file}", buffer.getvalue())
+            tables.append({
+                "file": table_file,
+                "page": page_number,
+                "caption": element.caption_text(document),
+                "columns": list(df.columns),
+                "rows": len(df),
+            })
+
+    return {"markdown": markdown, "images": images, "tables": tables}, image_export_seconds
+
+def table_dataframe(table, document):
+    df = table.export_to_dataframe(doc=document)
+    # Parquet needs unique string column names; Docling repeats or leaves out merged headers
+    columns, seen = [], {}
+    for i, column in enumerate(df.columns):
+        name = str(column).strip() or f"column_{i + 1}"
+        seen[name] = seen.get(name, 0) + 1
+        columns.append(name if seen[name] == 1 else f"{name}_{seen[name]}")
+    df.columns = columns
+    # Store numbers as numbers ("1,234.5" -> 1234.5) so tables can be filtered and aggregated
+    for column in df.columns:
+        values = df[column].astype(str).str.replace(",", "").str.strip()
+        try:
+            df[column] = pd.to_numeric(values.replace({"": None, "None": None, "nan": None}))
+        except (ValueError, TypeError):
+            df[column] = df[column].astype(str)
+    return df
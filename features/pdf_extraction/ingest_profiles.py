@@ -0,0 +1,11 @@
+# Kept apart from docling_pdf_extractor so the API can validate uploads without importing Docling
+
+# Ingest profiles selectable on upload
+#   fast:     never OCR, fast table model, no full-page images
+#   balanced: OCR only when some page has no usable text layer, no full-page images
+#   full:     always OCR, keep full-page images (previous behaviour)
+INGEST_PROFILES = ("fast", "balanced", "full")
+DEFAULT_INGEST_PROFILE = "balanced"
+
+# Written between pages of extracted_data.md; chunking for the chat side never crosses it
+PAGE_MARKER = "<!-- page {} -->"
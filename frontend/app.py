@@ -1,7 +1,10 @@
 import json
+import re
 import time
+import uuid
 import streamlit as st
 import requests, os, base64
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from litellm import completion
 from io import StringIO
@@ -13,6 +16,16 @@ load_dotenv()
 API_URL = os.getenv("API_DNS")
 # API_URL = "http://localhost:8000"
 
+# Cached API reads; the content TTL stays below the API's presigned image URL lifetime (IMAGE_URL_SECONDS)
+DOCUMENT_LIST_TTL_SECONDS = int(os.getenv("DOCUMENT_LIST_TTL_SECONDS", "60"))
+DOCUMENT_CONTENT_TTL_SECONDS = int(os.getenv("DOCUMENT_CONTENT_TTL_SECONDS", "600"))
+# The API gives up on an LLM reply after 30s; uploads run Docling and can take minutes on large PDFs
+LLM_TIMEOUT_SECONDS = int(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+UPLOAD_TIMEOUT_SECONDS = int(os.getenv("UPLOAD_TIMEOUT_SECONDS", "900"))
+# Preview size when a document has no page markers (web pages, older ingests)
+PREVIEW_PAGE_CHARS = int(os.getenv("PREVIEW_PAGE_CHARS", "8000"))
+PAGE_BREAK = re.compile(r"<!-- page \d+ -->")
+
 if "page" not in st.session_state:
     st.session_state.page = "Document Parser"
 if "text_url" not in st.session_state:
@@ -27,11 +40,62 @@ if 'pdf_content' not in st.session_state:
     st.session_state.pdf_content = ""
 if 'selected_file' not in st.session_state:
     st.session_state.selected_file = None
+if 'pdf_document' not in st.session_state:
+    st.session_state.pdf_document = None
+if 'image_urls' not in st.session_state:
+    st.session_state.image_urls = {}
+if 'upload_result' not in st.session_state:
+    st.session_state.upload_result = None
 if 'preview_content' not in st.session_state:
     st.session_state.preview_content = ""
 if 'file_selected' not in st.session_state:
     st.session_state.file_selected = False
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = str(uuid.uuid4())
  
+@st.cache_resource
+def http_session():
+    # One pooled keep-alive session per Streamlit server instead of a new connection per call
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_data(ttl=DOCUMENT_LIST_TTL_SECONDS, show_spinner=False)
+def fetch_documents():
+    response = http_session().get(f"{API_URL}/list_pdfcontent", timeout=30)
+    response.raise_for_status()
+    return sorted(response.json()["files"])
+
+@st.cache_data(ttl=DOCUMENT_CONTENT_TTL_SECONDS, max_entries=20, show_spinner=False)
+def fetch_document(selected_file):
+    response = http_session().post(f"{API_URL}/select_pdfcontent", json={"selected_file": selected_file}, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
+@st.cache_data(max_entries=20, show_spinner=False)
+def preview_pages(content):
+    """Split a document into pages for the preview: at page markers, else every ~PREVIEW_PAGE_CHARS along paragraphs."""
+    if PAGE_BREAK.search(content):
+        pages = [page.strip() for page in PAGE_BREAK.split(content)]
+        return [page for page in pages if page] or [""]
+    pages, current = [], ""
+    for paragraph in content.split("\n\n"):
+        if current and len(current) + len(paragraph) > PREVIEW_PAGE_CHARS:
+            pages.append(current)
+            current = ""
+        current += paragraph + "\n\n"
+    return pages + [current] if current or not pages else pages
+
+def render_preview(content, image_urls, key, unsafe_allow_html=False):
+    # Only the page on screen is rendered, so large documents stay responsive
+    pages = preview_pages(content)
+    page = 1
+    if len(pages) > 1:
+        page = st.number_input(f"Page (of {len(pages)})", min_value=1, max_value=len(pages), value=1, step=1, key=key)
+    st.markdown(with_image_urls(pages[page - 1], image_urls), unsafe_allow_html=unsafe_allow_html)
+
 def main():
     # Set up navigation
     st.sidebar.header("Main Menu")
@@ -71,29 +135,36 @@ def document_parser_page():
         st.session_state.file_upload = None
       
     st.session_state.file_upload = st.file_uploader("Choose a PDF File", type="pdf", accept_multiple_files=False)    
+    profile_options = {
+        "Balanced (OCR only for scanned pages)": "balanced",
+        "Fast (no OCR)": "fast",
+        "Full (always OCR)": "full",
+    }
+    selected_profile = st.selectbox("Ingest profile", options=list(profile_options.keys()))
     convert = st.button("Process", use_container_width=True)
         
     # Define what happens on each page
     if convert:
         if st.session_state.file_upload:
             st.success(f"File '{st.session_state.file_upload.name}' uploaded successfully!")
-            convert_PDF_to_markdown(st.session_state.file_upload)
+            convert_PDF_to_markdown(st.session_state.file_upload, profile_options[selected_profile])
         else:
             st.info("Please upload a PDF file.")
+
+    # Kept in the session so paging through the preview (a rerun) doesn't lose the result
+    if st.session_state.upload_result:
+        data = st.session_state.upload_result
+        st.subheader(data["message"])
+        render_preview(data["scraped_content"], data.get("image_urls", {}), key="upload_preview_page", unsafe_allow_html=True)
             
 def chat_page():
     st.title("Chat with your parsed documents... 🤖")
 
-    # Get available files from API
+    # Get available files from API (cached, so reruns on every widget change don't refetch)
     try:
-        response = requests.get(f"{API_URL}/list_pdfcontent")
-        if response.status_code == 200:
-            available_files = response.json()["files"]
-        else:
-            st.error("Error fetching available files")
-            available_files = []
+        available_files = fetch_documents()
     except Exception as e:
-        st.error(f"Error connecting to API: {e}")
+        st.error(f"Error fetching available files: {e}")
         available_files = []
     
     model_options = {
@@ -120,17 +191,11 @@ def chat_page():
     # Select PDF
     if st.sidebar.button("Select"):
         try:
-            response = requests.post(
-                f"{API_URL}/select_pdfcontent",
-                json={
-                    "selected_file": st.session_state.selected_file
-                }
-            )
-            if response.status_code == 200:
-                reset_state()
-                st.session_state.pdf_content = response.json()["content"]
-            else:
-                st.error(f"Error in Upload: {response.text}")
+            document = fetch_document(st.session_state.selected_file)
+            reset_state()
+            st.session_state.pdf_content = document["content"]
+            st.session_state.pdf_document = st.session_state.selected_file
+            st.session_state.image_urls = document.get("image_urls", {})
         except Exception as e:
             st.sidebar.error(f"Error: {e}")
     if st.session_state.pdf_content:
@@ -159,8 +224,9 @@ def chat_page():
         current_mode = st.session_state.mode
         
         if current_mode == 'preview':
-            st.session_state.preview_content = f"### {st.session_state.selected_file} - Preview \n\n {st.session_state.pdf_content}"
-            st.markdown(st.session_state.preview_content)
+            st.markdown(f"### {st.session_state.pdf_document} - Preview")
+            # Pages are split at the page markers, which st.markdown would otherwise print as text
+            render_preview(st.session_state.pdf_content, st.session_state.image_urls, key="preview_page")
 
         # Chat Functionality
         if current_mode == 'chat':
@@ -180,13 +246,16 @@ def chat_page():
                 with st.chat_message("assistant"):
                     with st.spinner("Thinking..."):
                         try:
-                            response = requests.post(
+                            response = http_session().post(
                                 f"{API_URL}/ask_question",
                                 json={
                                     "question": prompt,
                                     "selected_file": st.session_state.pdf_content,
-                                    "model": model_name
-                                }
+                                    "model": model_name,
+                                    "session_id": st.session_state.session_id,
+                                    "document": st.session_state.pdf_document
+                                },
+                                timeout=LLM_TIMEOUT_SECONDS,
                             )
                             
                             if response.status_code == 200:
@@ -206,12 +275,13 @@ def chat_page():
                 with st.chat_message("assistant"):
                     with st.spinner("Generating Summary..."):
                         try:
-                            response = requests.post(
+                            response = http_session().post(
                                 f"{API_URL}/summarize",
                                 json={
                                     "selected_file": st.session_state.pdf_content,
                                     "model": model_name
-                                }
+                                },
+                                timeout=LLM_TIMEOUT_SECONDS,
                             )
                             if response.status_code == 200:
                                 summary = response.json()["summary"]
@@ -232,12 +302,28 @@ def chat_page():
             st.session_state.file_selected = False
 
 def reset_state():
+    # Drop the server-side history and start a new conversation
+    try:
+        http_session().delete(f"{API_URL}/conversation/{st.session_state.session_id}", timeout=10)
+    except Exception:
+        pass
+    st.session_state.session_id = str(uuid.uuid4())
     st.session_state.messages = []
     st.session_state.pdf_content = ""
+    st.session_state.pdf_document = None
+    st.session_state.image_urls = {}
     st.session_state.preview_content = ""
+    st.session_state.pop("preview_page", None)
     st.session_state.mode = 'preview'
         
-def convert_PDF_to_markdown(file_upload):    
+def with_image_urls(content, image_urls):
+    # Stored markdown links images relative to the document; swap in the presigned URLs from the API
+    for path, url in image_urls.items():
+        if url:
+            content = content.replace(f"]({path})", f"]({url})")
+    return content
+
+def convert_PDF_to_markdown(file_upload, profile="balanced"):    
     progress_bar = st.progress(0)
     progress_text = st.empty()
     
@@ -251,19 +337,25 @@ def convert_PDF_to_markdown(file_upload):
         progress_text.text("Sending file for processing...")
         progress_bar.progress(50)
 
-        response = requests.post(f"{API_URL}/upload_pdf", json={"file": base64_pdf, "file_name": file_upload.name, "model": ""})
-        
-        progress_text.text("Processing document...")
-        progress_bar.progress(75)
-        
         try:
+            response = http_session().post(f"{API_URL}/upload_pdf", json={"file": base64_pdf, "file_name": file_upload.name, "model": "", "profile": profile},
+                                           timeout=UPLOAD_TIMEOUT_SECONDS)
+            
+            progress_text.text("Processing document...")
+            progress_bar.progress(75)
+            
             if response.status_code == 200:
                 data = response.json()
                 progress_text.text("Finalizing output...")
-                st.subheader(data["message"])
-                st.markdown(data["scraped_content"], unsafe_allow_html=True)
+                # New or re-ingested document: drop the cached list and contents
+                fetch_documents.clear()
+                fetch_document.clear()
+                st.session_state.upload_result = data
+                st.session_state.pop("upload_preview_page", None)
             else:
                 st.error("Server not responding.")
+        except requests.exceptions.Timeout:
+            st.error(f"Processing took longer than {UPLOAD_TIMEOUT_SECONDS}s. The document will show up under the parsed documents once the API finishes it.")
         except:
             st.error("An error occurred while processing the PDF.")
     
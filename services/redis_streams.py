@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from services.wire_format import decode_entry, decode_id
+
+
+def consumer_name(prefix=None):
+    """Unique consumer identity for this process: <prefix>-<host>-<pid>-<random>."""
+    prefix = prefix or "consumer"
+    return f"{prefix}-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+def workers_key(stream_name):
+    # Hash of consumer name -> latest stats reported by that worker
+    return f"{stream_name}:workers"
+
+
+def publish_worker_stats(redis_client, stream_name, consumer, in_flight, queued):
+    stats = {"in_flight": in_flight, "queued": queued, "updated": time.time()}
+    redis_client.hset(workers_key(stream_name), consumer, json.dumps(stats))
+
+
+def remove_worker_stats(redis_client, stream_name, consumer):
+    redis_client.hdel(workers_key(stream_name), consumer)
+
+
+def inflight_key(stream_name, model, prompt):
+    """Single-flight key for an LLM call: identical (model, prompt) pairs share one request while it runs."""
+    digest = hashlib.sha256(json.dumps([model, prompt], sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+    return f"{stream_name}:inflight:{digest}"
+
+
+def stream_stats(redis_client, stream_name, group_name, stale_after=60):
+    """Queue depth, consumer lag and in-flight counts for a stream consumed by a group.
+
+    Workers that have not reported for stale_after seconds are dropped from the
+    totals (and from Redis), so crashed replicas do not inflate the numbers."""
+    stats = {
+        "stream": stream_name,
+        "group": group_name,
+        "length": 0,
+        "lag": None,
+        "pending": 0,
+        "consumers": 0,
+        "in_flight": 0,
+        "queued": 0,
+        "workers": {},
+    }
+    if not redis_client.exists(stream_name):
+        return stats
+    stats["length"] = redis_client.xlen(stream_name)
+
+    for group in redis_client.xinfo_groups(stream_name):
+        if group["name"] == group_name:
+            # "lag" (entries not yet delivered to the group) is reported by Redis 7+
+            stats["lag"] = group.get("lag")
+            stats["pending"] = group["pending"]
+            stats["consumers"] = group["consumers"]
+
+    now = time.time()
+    for consumer, raw in redis_client.hgetall(workers_key(stream_name)).items():
+        worker = json.loads(raw)
+        if now - worker["updated"] > stale_after:
+            redis_client.hdel(workers_key(stream_name), consumer)
+            continue
+        stats["workers"][consumer] = worker
+        stats["in_flight"] += worker["in_flight"]
+        stats["queued"] += worker["queued"]
+    return stats
+
+
+class ResponseListener:
+    """Reads the response stream on a background thread and hands each entry to
+    the request waiting for it.
+
+    Every API replica runs one listener with a plain XREAD, so all replicas see
+    every response and no replica steals another's reply (as happens when they
+    share a consumer group), and concurrent requests inside one replica do not
+    compete for the same reads. redis_client must not decode responses; only
+    the waiting request unpacks the payload of its own entry."""
+
+    def __init__(self, redis_client, stream_name, block_ms=1000):
+        self.redis_client = redis_client
+        self.stream_name = stream_name
+        self.block_ms = block_ms
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="response-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.block_ms / 1000 + 1)
+
+    def register(self, request_id):
+        """Start waiting for request_id; call before publishing the request so the reply cannot be missed.
+
+        Several callers may wait on the same id (coalesced requests), each gets the reply."""
+        waiter = {"event": threading.Event(), "data": None}
+        with self._lock:
+            self._waiters.setdefault(request_id, []).append(waiter)
+        return waiter
+
+    def unregister(self, request_id, waiter):
+        with self._lock:
+            waiters = self._waiters.get(request_id, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self._waiters.pop(request_id, None)
+
+    def wait(self, request_id, waiter, timeout):
+        """Return the response entry for request_id, or None on timeout."""
+        try:
+            if waiter["event"].wait(timeout):
+                return waiter["data"]
+            return None
+        finally:
+            self.unregister(request_id, waiter)
+
+    def in_flight(self):
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _run(self):
+        last_id = None
+        while not self._stopping.is_set():
+            try:
+                if last_id is None:
+                    # Start after the newest existing entry; older responses belong to earlier requests
+                    latest = self.redis_client.xrevrange(self.stream_name, count=1)
+                    last_id = decode_id(latest[0][0]) if latest else "0-0"
+                entries = self.redis_client.xread({self.stream_name: last_id}, count=100, block=self.block_ms)
+            except Exception as e:
+                print(f"Error reading {self.stream_name}: {e}")
+                time.sleep(1)
+                continue
+            for stream_name, message_data in entries or []:
+                for message_id, data in message_data:
+                    last_id = decode_id(message_id)
+                    data = decode_entry(data)
+                    with self._lock:
+                        waiters = list(self._waiters.get(data.get("id"), ()))
+                    for waiter in waiters:
+                        waiter["data"] = data
+                        waiter["event"].set()
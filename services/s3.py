@@ -4,6 +4,7 @@ from datetime import datetime, timedelta
 import boto3.s3.transfer as transfer
 import os
 from dotenv import load_dotenv
+from services.telemetry import S3_LATENCY, timed
 load_dotenv()
 
 # Read values
@@ -20,23 +21,42 @@ class S3FileManager:
     
     def list_files(self, prefix=''):
         full_prefix = f'{self.base_path}/{prefix}'.strip('/')
-        response = self.s3.list_objects_v2(
-            Bucket=self.bucket_name,
-            Prefix=full_prefix
-        )
+        with timed(S3_LATENCY, operation="list_objects"):
+            response = self.s3.list_objects_v2(
+                Bucket=self.bucket_name,
+                Prefix=full_prefix
+            )
         return [obj['Key'] for obj in response.get('Contents', [])]
 
     def load_s3_file_content(self, file_name):
         try:
-            response = self.s3.get_object(Bucket=self.bucket_name, Key=file_name)
-            content = response['Body'].read().decode('utf-8')
+            with timed(S3_LATENCY, operation="get_object"):
+                response = self.s3.get_object(Bucket=self.bucket_name, Key=file_name)
+                content = response['Body'].read().decode('utf-8')
             return content
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error loading file {file_key}: {str(e)}")
     
+    def load_s3_file_bytes(self, file_name):
+        with timed(S3_LATENCY, operation="get_object"):
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=file_name)
+            return response['Body'].read()
+
+    def get_etag(self, file_name):
+        with timed(S3_LATENCY, operation="head_object"):
+            return self.s3.head_object(Bucket=self.bucket_name, Key=file_name)['ETag']
+
     def upload_file(self, bucket_name, file_name, content):
-        self.s3.put_object(Bucket=bucket_name, Key=file_name, Body=content)
+        with timed(S3_LATENCY, operation="put_object"):
+            self.s3.put_object(Bucket=bucket_name, Key=file_name, Body=content)
     
+    def delete_files(self, keys):
+        keys = list(keys)
+        # delete_objects takes at most 1000 keys per call
+        for start in range(0, len(keys), 1000):
+            with timed(S3_LATENCY, operation="delete_objects"):
+                self.s3.delete_objects(Bucket=self.bucket_name, Delete={"Objects": [{"Key": key} for key in keys[start:start + 1000]]})
+
     def get_presigned_url(self, object_name, expiration=3600):
         full_path = f'{self.base_path}/{object_name}'.strip('/')
         try:
@@ -63,12 +83,13 @@ class S3FileManager:
         
         for attempt in range(max_attempts):
             try:
-                self.s3.upload_file(
-                    file_path,
-                    bucket_name,
-                    object_name or file_path,
-                    Config=config
-                )
+                with timed(S3_LATENCY, operation="upload_file"):
+                    self.s3.upload_file(
+                        file_path,
+                        bucket_name,
+                        object_name or file_path,
+                        Config=config
+                    )
                 print(f'File uploaded successfully on attempt {attempt + 1}')
                 return True
             except Exception as e:
@@ -0,0 +1,84 @@
+"""Tracing and latency metrics shared by the API, the worker and the PDF pipeline.
+
+Spans are exported over OTLP when OTEL_EXPORTER_OTLP_ENDPOINT is set; trace
+context travels from the API to the worker inside the Redis request envelope.
+Histograms are exposed in the Prometheus text format: by the API at /metrics,
+and by the worker on WORKER_METRICS_PORT.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from opentelemetry import trace
+from opentelemetry.propagate import extract, inject
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from prometheus_client import Counter, Histogram
+
+# Spread from ~5ms to ~2min to cover both Redis hops and slow LLM / Docling calls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+QUEUE_WAIT = Histogram(
+    "llm_queue_wait_seconds", "Time a request spent in the Redis stream and the worker queue before dispatch",
+    ["model", "priority"], buckets=LATENCY_BUCKETS,
+)
+LLM_LATENCY = Histogram(
+    "llm_request_seconds", "Provider completion latency as seen by the worker",
+    ["model"], buckets=LATENCY_BUCKETS,
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds", "Time from dispatch to the first streamed token",
+    ["model"], buckets=LATENCY_BUCKETS,
+)
+API_LLM_ROUNDTRIP = Histogram(
+    "api_llm_roundtrip_seconds", "Time the API waited for the worker's response",
+    ["priority"], buckets=LATENCY_BUCKETS,
+)
+S3_LATENCY = Histogram(
+    "s3_operation_seconds", "S3 call latency",
+    ["operation"], buckets=LATENCY_BUCKETS,
+)
+DOCLING_STAGE = Histogram(
+    "docling_stage_seconds", "Docling time per document and pipeline stage (layout, ocr, table_structure, image_export, ...)",
+    ["stage"], buckets=LATENCY_BUCKETS,
+)
+RERANK_LATENCY = Histogram(
+    "rerank_seconds", "Time spent choosing the chunks sent with a question",
+    ["outcome"], buckets=LATENCY_BUCKETS,
+)
+COALESCED_REQUESTS = Counter(
+    "llm_coalesced_requests_total", "LLM calls answered by an identical request already in flight",
+    ["priority"],
+)
+
+tracer = trace.get_tracer("pdf-insights")
+
+
+def setup_tracing(service_name):
+    """Install the tracer provider for this process; spans are exported only if an OTLP endpoint is configured."""
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    if os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+
+
+def inject_trace_context():
+    """W3C trace context of the current span, to be carried in a message."""
+    carrier = {}
+    inject(carrier)
+    return carrier
+
+
+def extract_trace_context(carrier):
+    return extract(carrier or {})
+
+
+@contextmanager
+def timed(histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
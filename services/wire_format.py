@@ -0,0 +1,113 @@
+"""Compact, versioned envelope for payloads exchanged over the Redis streams.
+
+A stream entry carries the plain-text request id next to a single binary
+payload field, so readers can route an entry without decoding its payload:
+
+    {"id": "<request id>", "p": <envelope>}
+
+Requests may also carry an "inflight" field naming the single-flight key the
+worker clears when it publishes the reply (see redis_streams.inflight_key).
+
+The envelope is one header byte (format version), one flags byte, then a
+msgpack body, zstd-compressed when it is larger than ZSTD_THRESHOLD bytes.
+Entries must be written and read with a Redis client created with
+decode_responses=False.
+"""
+import os
+import threading
+
+import msgpack
+import zstandard
+
+WIRE_VERSION = 1
+FLAG_ZSTD = 0x01
+ZSTD_THRESHOLD = int(os.getenv("WIRE_ZSTD_THRESHOLD", "4096"))  # bytes
+ZSTD_LEVEL = int(os.getenv("WIRE_ZSTD_LEVEL", "1"))  # low levels already shrink prompts ~2x at a fraction of the CPU
+
+PAYLOAD_FIELD = "p"
+
+# zstd contexts are not safe to share between threads
+_local = threading.local()
+
+
+def _zstd():
+    if not hasattr(_local, "compressor"):
+        _local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        _local.decompressor = zstandard.ZstdDecompressor()
+    return _local.compressor, _local.decompressor
+
+
+def pack(obj):
+    body = msgpack.packb(obj, use_bin_type=True)
+    flags = 0
+    if len(body) > ZSTD_THRESHOLD:
+        body = _zstd()[0].compress(body)
+        flags |= FLAG_ZSTD
+    return bytes((WIRE_VERSION, flags)) + body
+
+
+def unpack(data):
+    version, flags = data[0], data[1]
+    if version != WIRE_VERSION:
+        raise ValueError(f"Unsupported wire format version {version}")
+    body = data[2:]
+    if flags & FLAG_ZSTD:
+        body = _zstd()[1].decompress(body)
+    return msgpack.unpackb(body, raw=False)
+
+
+def decode_entry(fields):
+    """Turn a raw stream entry into a dict with str keys; only the payload stays binary."""
+    if fields is None:
+        return None
+    entry = {}
+    for key, value in fields.items():
+        key = key.decode() if isinstance(key, bytes) else key
+        if key != PAYLOAD_FIELD and isinstance(value, bytes):
+            value = value.decode()
+        entry[key] = value
+    return entry
+
+
+def decode_id(message_id):
+    return message_id.decode() if isinstance(message_id, bytes) else message_id
+
+
+def encode_request(request_id, model, prompt, priority, trace=None, inflight=None):
+    # trace is the caller's W3C trace context so the worker's spans join the API's trace
+    entry = {
+        "id": request_id,
+        PAYLOAD_FIELD: pack({"model": model, "prompt": prompt, "priority": priority, "trace": trace or {}}),
+    }
+    if inflight:
+        entry["inflight"] = inflight
+    return entry
+
+
+def decode_request(entry):
+    return unpack(entry[PAYLOAD_FIELD])
+
+
+def encode_response(request_id, response):
+    """Keep only what the API reads from a litellm ModelResponse: the answer text and usage."""
+    usage = getattr(response, "usage", None)
+    return {
+        "id": request_id,
+        PAYLOAD_FIELD: pack({
+            "content": response.choices[0].message.content,
+            "model": response.model,
+            "usage": {
+                "prompt_tokens": getattr(usage, "prompt_tokens", None),
+                "completion_tokens": getattr(usage, "completion_tokens", None),
+                "total_tokens": getattr(usage, "total_tokens", None),
+            },
+        }),
+    }
+
+
+def encode_error(request_id, error):
+    return {"id": request_id, PAYLOAD_FIELD: pack({"error": str(error)})}
+
+
+def decode_response(entry):
+    return unpack(entry[PAYLOAD_FIELD])